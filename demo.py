@@ -9,7 +9,9 @@ async def run(bundle, func, body):
         print("Deploying")
         await man.deploy("demo", bundle)
         print("Calling")
-        await man.call_func("demo", func, body)
+        job = await man.invoke("demo", func, body)
+        print("Result:", await job)
+        print(f"Queued {job.queue_time:.3f}s, ran {job.run_time:.3f}s")
         print("Waiting")
         await man.join()
         print("Deleting")
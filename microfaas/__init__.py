@@ -1,9 +1,12 @@
 import logging
+import os
 
 from quart import Quart, current_app
 
+from . import buildah
+from .backends import BACKENDS
 from .config_app import blueprint as config_blueprint
-from .manager import Manager
+from .manager import BundleBusyError, Manager
 
 
 LOG = logging.getLogger(__name__)
@@ -16,7 +19,15 @@ app.register_blueprint(config_blueprint)
 async def create_manager():
     print("create_manager")
     LOG.info("Starting containers")
-    current_app.rt_man = Manager()
+    current_app.rt_man = Manager(
+        journal=os.environ.get('MICROFAAS_JOURNAL'),
+        runner_wheelhouse=os.environ.get('MICROFAAS_WHEELHOUSE'),
+        max_bundle_bytes=(
+            int(os.environ['MICROFAAS_BUNDLE_BYTES'])
+            if 'MICROFAAS_BUNDLE_BYTES' in os.environ else None
+        ),
+        backend=BACKENDS[os.environ.get('MICROFAAS_BACKEND', 'buildah')](),
+    )
     await current_app.rt_man.__aenter__()
     print("manager started", flush=True)
 
@@ -32,7 +43,20 @@ async def cleanup_manager():
     current_app.rt_man = None
 
 
+@app.errorhandler(BundleBusyError)
+def bundle_busy(exc):
+    return {"error": str(exc)}, 503, {"Retry-After": "1"}
+
+
 @app.route("/")
 def healthcheck():
     # return {"ok":"yes"}
-    return {"bundles": list(current_app.rt_man)}
+    return {
+        "bundles": list(current_app.rt_man),
+        "degraded": [
+            name
+            for name, bdata in current_app.rt_man.bundles.items()
+            if bdata.degraded
+        ],
+        "buildah": buildah.stats(),
+    }
@@ -1,20 +1,53 @@
 """
 Runner for inside the container
+
+Normally serves urp on stdin/stdout. With --listen SOCKET, it instead serves
+any number of connections to the unix socket, keeping stdout out of the way of
+the protocol. With --zygote SOCKET [MODULE...], it imports the given modules
+once, listens on the unix socket, and forks a worker (sharing those imports)
+to serve each connection. Both socket modes exit when stdin is closed.
+
+--functions JSON gives per-function options that override the manifest's.
+
+Generator functions (sync or async) can be called with $stream, which sends
+their items back as they're produced. The caller grants credit for more items
+with $credit as it consumes them, so a slow caller pauses the generator instead
+of having everything pile up in between.
+
+Calls may carry an ID (the $id param), which $cancel can use to stop them.
+
+With --payloads DIR, bytes bodies and results too big to push through the
+connection comfortably are passed as files in DIR instead (see SideChannel).
 """
+import argparse
 import asyncio
+import concurrent.futures
+import contextlib
 import functools
+import importlib
 import inspect
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import selectors
+import signal
+import socket
 import sys
+import uuid
 
+import msgpack
 import urp
 import urp.common
 
+LOG = logging.getLogger(__name__)
+
 try:
     from pkgutil import resolve_name
 except ImportError:
     # Copied from the 3.9 standard library
-    import importlib
-    import re
     _DOTTED_WORDS = r'(?!\d)(\w+)(\.(?!\d)(\w+))*'
     _NAME_PATTERN = re.compile(f'^(?P<pkg>{_DOTTED_WORDS})(?P<cln>:(?P<obj>{_DOTTED_WORDS})?)?$', re.U)
     del _DOTTED_WORDS
@@ -95,49 +128,795 @@ def kwargs_of_func(func):
         ]
 
 
+#: The bundle's list of functions, at the root of the bundle
+MANIFEST = 'microfaas.json'
+
+#: How a synchronous function can be run:
+#:  - inline: on the event loop, for functions that return immediately
+#:  - thread: in a thread pool (the shared one, unless workers is given)
+#:  - process: in a pool of worker processes, for CPU-bound functions
+EXECUTORS = ('inline', 'thread', 'process')
+
+#: The method name used for batched calls. Not a valid name for resolve_name(),
+#: so it can't collide with a real function.
+BATCH_METHOD = '$batch'
+
+#: The method name used to stream the items of a generator function
+STREAM_METHOD = '$stream'
+
+#: The method name used to let a stream send more items (or stop it)
+CREDIT_METHOD = '$credit'
+
+#: The method name used to cancel a call
+CANCEL_METHOD = '$cancel'
+
+#: The param giving the ID of a call, for CANCEL_METHOD
+CALL_ID = '$id'
+
+#: Marks the end of a generator run in an executor
+_END = object()
+
+#: bytes bodies and results at least this big go through the side channel
+PAYLOAD_THRESHOLD = 1024 * 1024
+
+#: The msgpack extension type of a reference to a side channel payload
+PAYLOAD_EXT = 0x4d
+
+_PAYLOAD_NAME = re.compile(r'[0-9a-f]{32}')
+
+
+def _fqn(cls):
+    """
+    The full name of a class, as urp reports errors.
+    """
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def _error_info(exc):
+    """
+    Produces the (name, additional) pair urp uses to describe an error.
+    """
+    additional = {
+        'args': exc.args,
+        'msg': str(exc),
+    }
+    additional.update(vars(exc))
+    return _fqn(type(exc)), additional
+
+
+class CallCancelledError(Exception):
+    """
+    The call was cancelled by the caller (usually because it took too long)
+    """
+
+
+def check_options(name, options):
+    """
+    Checks a function's options, raising ValueError if they don't make sense.
+    """
+    executor = options.get('executor', 'thread')
+    if executor not in EXECUTORS:
+        raise ValueError(f"{name}: unknown executor {executor!r}")
+    timeout = options.get('timeout')
+    if timeout is not None and (not isinstance(timeout, (int, float)) or timeout <= 0):
+        raise ValueError(f"{name}: timeout must be a positive number of seconds")
+    workers = options.get('workers')
+    if workers is not None:
+        if executor == 'inline':
+            raise ValueError(f"{name}: the inline executor has no workers")
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError(f"{name}: workers must be a positive integer")
+
+
+def check_manifest(manifest, overrides=None):
+    """
+    Checks a bundle's manifest, with overrides of its functions' options,
+    raising ValueError if it doesn't make sense.
+    """
+    functions = {}
+    if manifest is not None:
+        if not isinstance(manifest, dict):
+            raise ValueError("The manifest must be an object")
+        functions = manifest.get('functions', {})
+        if isinstance(functions, list):
+            functions = dict.fromkeys(functions)
+        elif isinstance(functions, dict):
+            functions = dict(functions)
+        else:
+            raise ValueError("functions must be a list of names or an object of options")
+        threads = manifest.get('threads')
+        if threads is not None and (not isinstance(threads, int) or threads < 1):
+            raise ValueError("threads must be a positive integer")
+        preload = manifest.get('preload')
+        if preload is not None and (
+            not isinstance(preload, list) or not all(isinstance(m, str) for m in preload)
+        ):
+            raise ValueError("preload must be a list of module names")
+    for name, options in (overrides or {}).items():
+        functions[name] = {**(functions.get(name) or {}), **options}
+    for name, options in functions.items():
+        if options is not None and not isinstance(options, dict):
+            raise ValueError(f"{name}: options must be an object")
+        check_options(name, options or {})
+
+
+def _cpu_count():
+    """
+    How many CPUs this process may run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+#: The function of a process pool worker (see _init_process())
+_process_func = None
+
+
+def _init_process(name):
+    global _process_func
+    _process_func = resolve_name(name)
+
+
+def _call_in_process(body, args):
+    try:
+        result = _process_func(body, **args)
+        if inspect.isgenerator(result):
+            # Generators can't be sent back, so the items come back together
+            result = list(result)
+        return result
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+class SideChannel:
+    """
+    A directory shared by the host and the runner (on tmpfs), for passing big
+    bytes payloads without copying them through the connection.
+
+    The sender writes the payload to a file, and sends just its name, as a
+    msgpack extension type. The receiver maps the file, and gets a read-only
+    memoryview of it.
+    """
+    def __init__(self, path, threshold=PAYLOAD_THRESHOLD):
+        #: The directory, or None to send everything inline
+        self.path = path
+        self.threshold = threshold
+
+    def _file(self, ref):
+        name = ref.data.decode('ascii', 'replace')
+        # Names come from the other side, so don't let them point elsewhere
+        if self.path is None or not _PAYLOAD_NAME.fullmatch(name):
+            raise ValueError(f"Bad payload reference {name!r}")
+        return os.path.join(self.path, name)
+
+    @staticmethod
+    def _is_ref(value):
+        return isinstance(value, msgpack.ExtType) and value.code == PAYLOAD_EXT
+
+    def store(self, value):
+        """
+        If value is bytes big enough to be worth it, writes it out and returns
+        a reference to it. Anything else is returned as is.
+        """
+        if (
+            self.path is None
+            or not isinstance(value, (bytes, bytearray, memoryview))
+            or memoryview(value).nbytes < max(self.threshold, 1)
+        ):
+            return value
+        name = uuid.uuid4().hex
+        with open(os.path.join(self.path, name), 'xb') as f:
+            f.write(value)
+        return msgpack.ExtType(PAYLOAD_EXT, name.encode('ascii'))
+
+    def load(self, value):
+        """
+        If value is a reference, maps the payload and returns a memoryview of
+        it. Anything else is returned as is.
+        """
+        if not self._is_ref(value):
+            return value
+        fd = os.open(self._file(value), os.O_RDONLY | os.O_NOFOLLOW)
+        try:
+            return memoryview(mmap.mmap(fd, 0, access=mmap.ACCESS_READ))
+        finally:
+            os.close(fd)
+
+    def take(self, value):
+        """
+        Like load(), but also removes the file. The mapping stays valid.
+        """
+        result = self.load(value)
+        self.discard(value)
+        return result
+
+    def discard(self, value):
+        """
+        Removes the file of a reference, if value is one.
+        """
+        if self._is_ref(value):
+            try:
+                os.unlink(self._file(value))
+            except FileNotFoundError:
+                pass
+
+
+class Export:
+    """
+    A function the runner will call, with everything about it that can be
+    worked out ahead of time.
+
+    Synchronous functions are run by the executor named in the options (see
+    EXECUTORS). Dedicated pools are created on first use, so that a zygote
+    doesn't fork workers with threads or processes attached.
+
+    If a call is cancelled, a coroutine is cancelled, and a thread is left to
+    finish on its own. A worker process can actually be stopped, so the
+    process pool is replaced, and its workers are terminated.
+    """
+    def __init__(self, name, options=None):
+        self.name = name
+        self.options = options or {}
+        check_options(name, self.options)
+        self.func = resolve_name(name)
+        self.accepted = kwargs_of_func(self.func)
+        self.is_async = inspect.iscoroutinefunction(self.func)
+        self.is_asyncgen = inspect.isasyncgenfunction(self.func)
+        self.is_generator = inspect.isgeneratorfunction(self.func)
+        self.batch = self.options.get('batch', getattr(self.func, 'microfaas_batch', False))
+        self.executor = self.options.get('executor', 'thread')
+        self.workers = self.options.get('workers')
+        self._pool = None
+
+    def _args(self, params):
+        """
+        Picks out the params the function accepts.
+        """
+        if self.accepted is ...:
+            return params
+        else:
+            return {
+                k: v
+                for k, v in params.items()
+                if k in self.accepted
+            }
+
+    async def __call__(self, body, params):
+        """
+        Calls the function with the body and whichever of the extra params it
+        accepts.
+
+        The items of generator functions are returned as a list.
+        """
+        if self.is_asyncgen or self.is_generator:
+            return [item async for item in self.stream(body, params)]
+
+        args = self._args(params)
+        try:
+            if self.is_async:
+                return await self.func(body, **args)
+            elif self.executor == 'inline':
+                return self.func(body, **args)
+            elif self.executor == 'process':
+                return await self._in_process(body, args)
+            else:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self.pool(), functools.partial(self.func, body, **args),
+                )
+        finally:
+            sys.stdout.flush()  # Dunno why line flushing isn't working
+            sys.stderr.flush()
+
+    async def stream(self, body, params):
+        """
+        Calls the function, yielding its items if it's a generator, or its
+        result if it isn't.
+
+        Sync generators are advanced in the function's executor, one item at
+        a time, except in a process pool, where they're run to completion.
+        """
+        args = self._args(params)
+        loop = asyncio.get_running_loop()
+        try:
+            if self.is_asyncgen:
+                items = self.func(body, **args)
+                try:
+                    async for item in items:
+                        yield item
+                finally:
+                    await items.aclose()
+            elif self.is_generator and self.executor == 'process':
+                for item in await self._in_process(body, args):
+                    yield item
+            elif self.is_generator:
+                items = self.func(body, **args)
+                try:
+                    while True:
+                        if self.executor == 'inline':
+                            item = next(items, _END)
+                        else:
+                            item = await loop.run_in_executor(self.pool(), next, items, _END)
+                        if item is _END:
+                            break
+                        yield item
+                finally:
+                    items.close()
+            else:
+                yield await self(body, params)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+    async def _in_process(self, body, args):
+        if isinstance(body, memoryview):
+            # A mapped payload can't be sent to another process
+            body = body.tobytes()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.pool(), _call_in_process, body, args)
+        except asyncio.CancelledError:
+            self._kill_pool()
+            raise
+
+    def _kill_pool(self):
+        """
+        Replaces the process pool, terminating its workers.
+
+        Other calls running in the pool fail.
+        """
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        # There's no public way to get at the workers
+        processes = list((getattr(pool, '_processes', None) or {}).values())
+        pool.shutdown(wait=False)
+        for proc in processes:
+            proc.terminate()
+        LOG.warning("Terminated %d workers of %s", len(processes), self.name)
+
+    def pool(self):
+        """
+        Gets the executor for this function, creating it if needed.
+
+        None means the event loop's default executor.
+        """
+        if self._pool is None:
+            if self.executor == 'process':
+                # Workers come from a forkserver that has already imported
+                # the function's module, and resolve it once at startup
+                ctx = multiprocessing.get_context('forkserver')
+                ctx.set_forkserver_preload(['__main__', self.func.__module__])
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.workers or _cpu_count(),
+                    mp_context=ctx,
+                    initializer=_init_process,
+                    initargs=(self.name,),
+                )
+            elif self.workers is not None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(
+                    self.workers, thread_name_prefix=self.name,
+                )
+        return self._pool
+
+    def close(self):
+        """
+        Shuts down this function's executor, if it has its own.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+def load_manifest():
+    """
+    Reads the bundle's manifest, if it has one.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), MANIFEST)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class _Credit:
+    """
+    How many more items a stream may send.
+    """
+    def __init__(self, initial):
+        self.available = initial
+        self.stopped = False
+        self._changed = asyncio.Event()
+
+    async def take(self):
+        """
+        Waits for credit to send an item. Returns False if the stream has been
+        stopped instead.
+        """
+        while self.available <= 0 and not self.stopped:
+            self._changed.clear()
+            await self._changed.wait()
+        if self.stopped:
+            return False
+        self.available -= 1
+        return True
+
+    def give(self, count):
+        self.available += count
+        self._changed.set()
+
+    def stop(self):
+        self.stopped = True
+        self._changed.set()
+
+
+class _EofProtocol(asyncio.Protocol):
+    """
+    Resolves a future when the pipe it's reading is closed.
+    """
+    def __init__(self, closed):
+        self.closed = closed
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
 class UrpServer:
+    """
+    Serves the bundle's functions over urp.
+
+    If the bundle has a manifest, its functions are resolved when the server
+    is created, and nothing else can be called. Otherwise, any name is
+    resolved the first time it's called.
+
+    overrides maps function names to options to use over the manifest's.
+
+    side_channel is a SideChannel for big payloads.
+    """
+    def __init__(self, manifest=..., overrides=None, side_channel=None):
+        if manifest is ...:
+            manifest = load_manifest()
+        self.restricted = manifest is not None
+        self.side_channel = side_channel or SideChannel(None)
+        self.exports = {}
+        #: The credit of streams in progress, by ID
+        self.credits = {}
+        #: The tasks of calls that can be cancelled, by ID
+        self.calls = {}
+        self._cancelled = set()
+        functions = {}
+        if manifest is not None:
+            functions = manifest.get('functions', {})
+            if isinstance(functions, list):
+                functions = dict.fromkeys(functions)
+            # Sizes the default executor, used by most sync functions
+            self.threads = manifest.get('threads')
+        else:
+            self.threads = None
+        for name, options in (overrides or {}).items():
+            functions[name] = {**(functions.get(name) or {}), **options}
+        for name, options in functions.items():
+            self.exports[name] = Export(name, options)
+
+    def export(self, key):
+        """
+        Gets the Export for a name, raising KeyError if it can't be called.
+        """
+        try:
+            return self.exports[key]
+        except KeyError:
+            if self.restricted:
+                raise
+        try:
+            export = self.exports[key] = Export(key)
+        except (ValueError, ImportError, AttributeError) as exc:
+            raise KeyError(key) from exc
+        return export
+
     def __getitem__(self, key):
-        func = resolve_name(key)
-
-        @functools.wraps(func)
-        async def _(**params):
-            body = params.pop('_') 
-            accepted = kwargs_of_func(func)
-            if accepted is ...:
-                args = params
-            else:
-                args = {
-                    k: v
-                    for k, v in params.items()
-                    if k in accepted
-                }
+        if key == BATCH_METHOD:
+            return self.batch
+        elif key == STREAM_METHOD:
+            return self.stream
+        elif key == CREDIT_METHOD:
+            return self.credit
+        elif key == CANCEL_METHOD:
+            return self.cancel
+        export = self.export(key)
 
-            # Actually call the function
+        async def method(**params):
+            return await self.call(export, params)
+
+        return method
+
+    @contextlib.contextmanager
+    def _cancellable(self, call_id):
+        """
+        Lets the current call be stopped with cancel(call_id), in which case
+        it raises CallCancelledError.
+        """
+        if call_id is None:
+            yield
+            return
+        self.calls[call_id] = asyncio.current_task()
+        try:
+            yield
+        except asyncio.CancelledError:
+            if call_id in self._cancelled:
+                raise CallCancelledError(f"Call {call_id} was cancelled") from None
+            raise
+        finally:
+            self.calls.pop(call_id, None)
+            self._cancelled.discard(call_id)
+
+    async def call(self, export, params):
+        """
+        Makes a single call.
+        """
+        with self._cancellable(params.pop(CALL_ID, None)):
+            body = self.side_channel.load(params.pop('_'))
+            return self.side_channel.store(await export(body, params))
+
+    def cancel(self, call):
+        """
+        Cancels the call with the given ID. Returns False if there's no such
+        call (anymore).
+        """
+        try:
+            task = self.calls[call]
+        except KeyError:
+            return False
+        self._cancelled.add(call)
+        task.cancel()
+        return True
+
+    async def batch(self, func, items, **params):
+        """
+        Makes several calls to one function.
+
+        items is a list of param dicts, like a normal call would take. Returns
+        a list with one [True, result] or [False, error name, error info] per
+        item.
+
+        Functions marked as batching (by a true microfaas_batch attribute, or
+        in the manifest) are called once with a list of the bodies, and must
+        return a list of results. Other functions are called once per item.
+        """
+        with self._cancellable(params.get(CALL_ID)):
+            return await self._batch(self.export(func), items)
+
+    async def _batch(self, export, items):
+        side = self.side_channel
+        if export.batch:
+            bodies = [side.load(item['_']) for item in items]
             try:
-                if inspect.iscoroutinefunction(func):
-                    return await func(body, **args)
+                results = list(await export(bodies, {}))
+                if len(results) != len(items):
+                    raise ValueError(
+                        f"{export.name} returned {len(results)} results for {len(items)} items"
+                    )
+            except Exception as exc:
+                return [[False, *_error_info(exc)]] * len(items)
+            return [[True, side.store(result)] for result in results]
+        else:
+            responses = []
+            for item in items:
+                params = dict(item)
+                body = side.load(params.pop('_'))
+                try:
+                    result = await export(body, params)
+                except Exception as exc:
+                    responses.append([False, *_error_info(exc)])
                 else:
-                    loop = asyncio.get_running_loop()
-                    return await loop.run_in_executor(None, functools.partial(func, body, **args))
-            finally:
-                sys.stdout.flush()  # Dunno why line flushing isn't working
-                sys.stderr.flush()
+                    responses.append([True, side.store(result)])
+            return responses
+
+    async def stream(self, func, stream, window, **params):
+        """
+        Calls a function, sending back its items as they're produced.
+
+        stream is an ID for the stream chosen by the caller, to refer to it
+        with credit(). Up to window items are sent before waiting for credit.
+        """
+        export = self.export(func)
+        call_id = params.pop(CALL_ID, None)
+        body = self.side_channel.load(params.pop('_'))
+        credit = self.credits[stream] = _Credit(window)
+        items = export.stream(body, params)
+        try:
+            with self._cancellable(call_id):
+                # Don't produce an item until it can be sent
+                while await credit.take():
+                    try:
+                        item = await items.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    yield self.side_channel.store(item)
+        finally:
+            del self.credits[stream]
+            await items.aclose()
+
+    def credit(self, stream, count=0, stop=False):
+        """
+        Lets a stream send count more items, or stops it early.
+        """
+        try:
+            credit = self.credits[stream]
+        except KeyError:
+            # Already finished
+            return
+        if stop:
+            credit.stop()
+        else:
+            credit.give(count)
+
+    def _setup_loop(self):
+        if self.threads is not None:
+            asyncio.get_running_loop().set_default_executor(
+                concurrent.futures.ThreadPoolExecutor(self.threads),
+            )
 
-        return _
+    def close(self):
+        """
+        Shuts down the functions' executors.
+        """
+        for export in self.exports.values():
+            export.close()
 
     async def serve_stdio(self):
         """
         Serve a client connected by stdin/stdout
         """
+        self._setup_loop()
         transpo, proto = await urp.common.connect_stdio(
             lambda: urp.server.ServerStreamProtocol(self),
         )
-        await proto.finished()
+        try:
+            await proto.finished()
+        finally:
+            self.close()
+
+    async def serve_unix(self, path):
+        """
+        Serve every client that connects to the unix socket at path, until
+        stdin is closed.
+        """
+        self._setup_loop()
+        loop = asyncio.get_running_loop()
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = await loop.create_unix_server(
+            lambda: urp.server.ServerStreamProtocol(self),
+            path,
+        )
+        closed = loop.create_future()
+        await loop.connect_read_pipe(lambda: _EofProtocol(closed), sys.stdin)
+        try:
+            await closed
+        finally:
+            listener.close()
+            await listener.wait_closed()
+            self.close()
+
+    async def serve_socket(self, sock):
+        """
+        Serve a client connected by an accepted socket
+        """
+        self._setup_loop()
+        loop = asyncio.get_running_loop()
+        transpo, proto = await loop.connect_accepted_socket(
+            lambda: urp.server.ServerStreamProtocol(self),
+            sock=sock,
+        )
+        try:
+            await proto.finished()
+        finally:
+            self.close()
+
+
+def _serve_forked(server, conn):
+    """
+    Body of a forked worker. Never returns.
+    """
+    try:
+        asyncio.run(server.serve_socket(conn))
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
+
+def zygote(path, preload, overrides=None, side_channel=None):
+    """
+    Import preload (and the manifest's functions), then fork a worker for
+    each connection to the unix socket at path.
+
+    Exits (taking the workers with it) when stdin is closed.
+    """
+    for name in preload:
+        importlib.import_module(name)
+    server = UrpServer(overrides=overrides, side_channel=side_channel)
 
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(16)
+
+    children = set()
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ)
+    sel.register(sys.stdin.fileno(), selectors.EVENT_READ)
+    try:
+        while True:
+            for key, _ in sel.select(timeout=1.0):
+                if key.fileobj is listener:
+                    conn, _ = listener.accept()
+                    # Don't let the worker inherit anything half-written
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    pid = os.fork()
+                    if pid == 0:
+                        sel.close()
+                        listener.close()
+                        _serve_forked(server, conn)
+                    conn.close()
+                    children.add(pid)
+                elif not os.read(key.fd, 1024):
+                    # Our manager has gone away
+                    return
+
+            # Reap workers that have finished
+            while children:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                children.discard(pid)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        listener.close()
+        os.unlink(path)
+
+
+async def main(overrides=None, side_channel=None, listen=None):
+    server = UrpServer(overrides=overrides, side_channel=side_channel)
+    if listen:
+        await server.serve_unix(listen)
+    else:
+        await server.serve_stdio()
+
+
+def parse_args(argv=None):
+    """
+    Parses the runner's command line (see the top of this file).
+    """
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--listen', metavar='SOCKET')
+    mode.add_argument('--zygote', metavar='SOCKET')
+    parser.add_argument('--functions', type=json.loads, metavar='JSON')
+    parser.add_argument('--payloads', metavar='DIR')
+    parser.add_argument('--payload-threshold', type=int, default=PAYLOAD_THRESHOLD, metavar='BYTES')
+    parser.add_argument('preload', nargs='*')
+    return parser.parse_args(argv)
 
-async def main():
-    server = UrpServer()
-    await server.serve_stdio()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    args = parse_args()
+    side_channel = SideChannel(args.payloads, args.payload_threshold)
+    if args.zygote:
+        zygote(args.zygote, args.preload, args.functions, side_channel)
+    else:
+        asyncio.run(main(args.functions, side_channel, args.listen))
@@ -0,0 +1,200 @@
+"""
+Grows and shrinks the runtime pools of bundles based on load.
+"""
+import asyncio
+import dataclasses
+import logging
+import statistics
+import time
+import typing
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class ScalingPolicy:
+    """
+    How a bundle's pool of runtimes should be sized.
+
+    Scaling up and down use separate thresholds, and each has to hold for
+    several consecutive checks before anything happens, so that a pool doesn't
+    flap around a single threshold.
+    """
+    #: The fewest runtimes to keep. 0 lets idle bundles release all containers.
+    min_replicas: int = 1
+    #: The most runtimes to run
+    max_replicas: int = 1
+    #: Queued calls per unit of capacity above which to add a runtime
+    scale_up_depth: float = 1.0
+    #: Mean call latency (seconds) above which to add a runtime, if calls are
+    #: waiting. None disables this signal.
+    target_latency: typing.Optional[float] = None
+    #: Fraction of capacity in use below which a runtime may be retired
+    scale_down_utilization: float = 0.25
+    #: Consecutive checks the scale up condition must hold
+    scale_up_checks: int = 2
+    #: Consecutive checks the scale down condition must hold
+    scale_down_checks: int = 30
+    #: Seconds to wait after any scaling before scaling up again
+    scale_up_cooldown: float = 5.0
+    #: Seconds to wait after any scaling before scaling down again
+    scale_down_cooldown: float = 60.0
+
+    def __post_init__(self):
+        if self.min_replicas < 0:
+            raise ValueError("min_replicas cannot be negative")
+        if self.max_replicas < max(self.min_replicas, 1):
+            raise ValueError("max_replicas must be at least min_replicas and 1")
+
+
+@dataclasses.dataclass
+class _BundleState:
+    """
+    What the autoscaler remembers about a bundle between checks.
+    """
+    up_streak: int = 0
+    down_streak: int = 0
+    last_scaled: float = float('-inf')
+
+
+class Autoscaler:
+    """
+    Periodically looks over the bundles of a Manager and adds or retires
+    runtimes according to each bundle's ScalingPolicy.
+    """
+    def __init__(self, manager, *, interval=1.0):
+        self.manager = manager
+        self.interval = interval
+        self._state = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        #: Scaling actions in progress, by bundle name
+        self._scaling = {}
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._loop(), name="autoscaler")
+        return self
+
+    async def __aexit__(self, *exc):
+        tasks = [self._task, *self._scaling.values()]
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                LOG.exception("Error stopping autoscaler")
+
+    def poke(self):
+        """
+        Check now instead of waiting for the next interval.
+
+        Used when calls arrive for a bundle that has no runtimes at all.
+        """
+        self._wakeup.set()
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            # Forget bundles that have been deleted
+            for name in list(self._state):
+                if name not in self.manager.bundles:
+                    del self._state[name]
+
+            for name, bdata in list(self.manager.bundles.items()):
+                if bdata.scaling is None or name in self._scaling:
+                    # Not autoscaled, or the last change is still going on
+                    continue
+                try:
+                    action = self._check(name, bdata)
+                except Exception:
+                    LOG.exception("Error autoscaling %s", name)
+                    continue
+                if action is not None:
+                    # Starting a runtime can take a while; don't hold up
+                    # other bundles for it
+                    self._scaling[name] = asyncio.create_task(
+                        self._scale(name, action), name=f"{name}-scaling",
+                    )
+
+    async def _scale(self, name, action):
+        """
+        Carries out a scaling action decided by _check().
+        """
+        try:
+            await action(name)
+        except Exception:
+            LOG.exception("Error autoscaling %s", name)
+        finally:
+            state = self._state.get(name)
+            if state is not None:
+                # Cool down from when the change took effect
+                state.last_scaled = time.monotonic()
+            del self._scaling[name]
+
+    def _check(self, name, bdata):
+        """
+        Look at one bundle and decide whether to scale it.
+
+        Returns the Manager method to call with the bundle name, or None.
+        """
+        policy = bdata.scaling
+        state = self._state.setdefault(name, _BundleState())
+        now = time.monotonic()
+
+        replicas = len(bdata.runtimes)
+        # The consumer holds the next call (or batch) while it waits for a
+        # runtime, which is all there is when scaled to zero
+        depth = bdata.queue.qsize() + bdata.waiting
+        capacity = sum(rt.capacity for rt in bdata.runtimes)
+        busy = sum(rt.in_flight for rt in bdata.runtimes)
+        latency = statistics.mean(bdata.latencies) if bdata.latencies else 0.0
+
+        if replicas == 0:
+            # Scaled to zero and work showed up; don't make it wait
+            if depth:
+                LOG.info("Scaling %s up from zero", name)
+                state.up_streak = state.down_streak = 0
+                state.last_scaled = now
+                return self.manager.add_replica
+            return None
+
+        overloaded = depth > policy.scale_up_depth * capacity or (
+            policy.target_latency is not None
+            and depth > 0
+            and latency > policy.target_latency
+        )
+        idle = depth == 0 and busy < policy.scale_down_utilization * capacity
+
+        state.up_streak = state.up_streak + 1 if overloaded else 0
+        state.down_streak = state.down_streak + 1 if idle else 0
+
+        if (
+            state.up_streak >= policy.scale_up_checks
+            and replicas < policy.max_replicas
+            and now - state.last_scaled >= policy.scale_up_cooldown
+        ):
+            LOG.info(
+                "Scaling %s up to %d (depth=%d, latency=%.3fs)",
+                name, replicas + 1, depth, latency,
+            )
+            state.up_streak = state.down_streak = 0
+            state.last_scaled = now
+            return self.manager.add_replica
+        elif (
+            state.down_streak >= policy.scale_down_checks
+            and replicas > policy.min_replicas
+            and now - state.last_scaled >= policy.scale_down_cooldown
+        ):
+            LOG.info("Scaling %s down to %d", name, replicas - 1)
+            state.up_streak = state.down_streak = 0
+            state.last_scaled = now
+            return self.manager.retire_replica
+        return None
@@ -0,0 +1,619 @@
+"""
+Ways of running a runtime's processes in its container.
+"""
+import asyncio
+import contextlib
+import importlib
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+
+import urp.server
+
+from .__runner__ import SideChannel, UrpServer, parse_args
+from .buildah import Container
+
+LOG = logging.getLogger(__name__)
+
+#: PATH inside the container, if its image doesn't set one (same as buildah's)
+DEFAULT_PATH = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
+
+
+def _volume_pairs(volumes):
+    """
+    Normalizes volumes ("host:guest" strings or (host, guest) pairs) to pairs.
+    """
+    for vol in volumes or ():
+        if isinstance(vol, str):
+            host, guest = vol.split(':')[:2]
+        else:
+            host, guest = vol[:2]
+        yield str(host), str(guest)
+
+
+def _remove_tree(path):
+    """
+    Removes a directory tree, making its directories writable first.
+
+    The kernel leaves an overlay's work/work without any permissions, which
+    keeps even its owner from removing it as is.
+    """
+    os.chmod(path, 0o700)
+    for dirpath, dirnames, _ in os.walk(path):
+        for name in dirnames:
+            sub = os.path.join(dirpath, name)
+            if not os.path.islink(sub):
+                os.chmod(sub, 0o700)
+    shutil.rmtree(path)
+
+
+class Backend:
+    """
+    How a Runtime gets a container of its image and starts processes in it.
+
+    create() gives a container: something with popen() and
+    popen_with_protocol() methods like those of buildah.Container, that's an
+    async context manager removing it at exit, and whose str() identifies it
+    in logs.
+    """
+    async def create(self, image, pool=None):
+        """
+        Gets a container of image, from the WarmPool pool if one is given.
+
+        The container has been entered, and the caller has to exit it.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    async def _container(image, pool):
+        if pool is not None:
+            cont = await pool.take(image)
+        else:
+            cont = await Container(image)
+        return await cont.__aenter__()
+
+
+class BuildahBackend(Backend):
+    """
+    Runs every process with `buildah run`.
+    """
+    async def create(self, image, pool=None):
+        return await self._container(image, pool)
+
+
+class DirectBackend(Backend):
+    """
+    Mounts the container's filesystem once, and runs processes in it directly
+    in fresh namespaces, without going through buildah.
+
+    Restarting a runner is then a fork and exec of the sandboxing tool, rather
+    than a run of buildah (which has to look the container up and set it up
+    each time). Containers from a WarmPool are already mounted, so a scale out
+    doesn't run buildah at all.
+
+    sandbox is "bwrap" (bubblewrap, 0.8 or later for shared layers) or
+    "unshare" (util-linux unshare, mount and chroot, which need root). By
+    default, bwrap is used if it's installed.
+
+    If shared, every container of an image is an overlay: the filesystem of
+    one mounted container of the image is the read-only lower layer, and each
+    gets a writable upper layer of its own (a directory in layer_dir). So
+    replicas of a bundle share one copy of it on disk and in the page cache,
+    and adding a replica is making a directory. The overlay is mounted in the
+    runner's own mount namespace, and goes away with it.
+    """
+    def __init__(self, sandbox=None, *, shared=True, layer_dir=None):
+        if sandbox is None:
+            sandbox = 'bwrap' if shutil.which('bwrap') else 'unshare'
+        if sandbox not in ('bwrap', 'unshare'):
+            raise ValueError(f"Unknown sandbox {sandbox!r}")
+        self.sandbox = sandbox
+        self.executable = shutil.which(sandbox)
+        if self.executable is None:
+            raise FileNotFoundError(f"{sandbox} is not installed")
+        #: Whether containers of the same image share a lower layer
+        self.shared = shared
+        #: Where to make the writable layers of shared containers
+        self.layer_dir = layer_dir
+        self._layers = {}
+
+    async def create(self, image, pool=None):
+        if self.shared:
+            return await self._create_shared(image, pool)
+        cont, root = await self._mounted(image, pool)
+        return DirectContainer(cont, root, self)
+
+    async def _mounted(self, image, pool):
+        cont = await self._container(image, pool)
+        try:
+            root = cont.mountpoint or await cont.mount_root()
+        except:
+            await cont.__aexit__(None, None, None)
+            raise
+        return cont, root
+
+    async def _create_shared(self, image, pool):
+        key = str(image)
+        layer = self._layers.get(key)
+        if layer is None:
+            layer = self._layers[key] = _SharedLayer(
+                asyncio.ensure_future(self._mounted(image, pool)),
+            )
+        layer.refs += 1
+        try:
+            cont, root = await asyncio.shield(layer.ready)
+            upper = tempfile.mkdtemp(prefix='microfaas-layer-', dir=self.layer_dir)
+            for name in ('upper', 'work', 'root'):
+                os.mkdir(os.path.join(upper, name))
+        except BaseException:
+            await self._release(key, layer)
+            raise
+        return DirectContainer(cont, root, self, upper=upper, release=lambda: self._release(key, layer))
+
+    async def _release(self, key, layer):
+        """
+        A container of a shared layer is done with it. The last one removes
+        the layer's container.
+        """
+        layer.refs -= 1
+        if layer.refs > 0:
+            return
+        if self._layers.get(key) is layer:
+            del self._layers[key]
+        if not layer.ready.done():
+            layer.ready.cancel()
+            return
+        if layer.ready.cancelled() or layer.ready.exception() is not None:
+            return
+        cont, _ = layer.ready.result()
+        await cont.__aexit__(None, None, None)
+
+
+class _SharedLayer:
+    """
+    A mounted container whose filesystem is the lower layer of others.
+    """
+    def __init__(self, ready):
+        #: Gives the container and where it's mounted
+        self.ready = ready
+        #: How many containers are using it
+        self.refs = 0
+
+
+class DirectContainer:
+    """
+    A buildah Container whose processes are started by a DirectBackend.
+
+    If upper is given, the container's filesystem is only the lower layer of
+    an overlay, and upper is the directory for the writable layer.
+    """
+    def __init__(self, container, root, backend, *, upper=None, release=None):
+        #: The underlying buildah.Container
+        self.container = container
+        #: Where the container's filesystem is mounted
+        self.root = root
+        self.backend = backend
+        #: The writable layer over root, if it's shared
+        self.upper = upper
+        self._release = release
+
+    def __str__(self):
+        if self.upper is not None:
+            return f"{self.container}/{os.path.basename(self.upper)}"
+        return str(self.container)
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self} at {self.root}>'
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.upper is None:
+            await self.container.__aexit__(*exc)
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, _remove_tree, self.upper)
+        except OSError:
+            LOG.exception("Error removing writable layer %s", self.upper)
+        await self._release()
+
+    def _environ(self):
+        env = dict(self.container.environ)
+        env.setdefault('PATH', DEFAULT_PATH)
+        return env
+
+    def _bwrap_args(self, cmd, volumes):
+        if self.upper is not None:
+            args = [
+                self.backend.executable,
+                '--overlay-src', str(self.root),
+                '--overlay', f'{self.upper}/upper', f'{self.upper}/work', '/',
+            ]
+        else:
+            args = [self.backend.executable, '--bind', str(self.root), '/']
+        args += [
+            '--dev', '/dev',
+            '--tmpfs', '/dev/shm',
+            '--proc', '/proc',
+            '--unshare-pid', '--unshare-ipc', '--unshare-uts',
+            '--die-with-parent',
+            '--chdir', self.container.workdir or '/',
+        ]
+        for host, guest in _volume_pairs(volumes):
+            args += ['--bind', host, guest]
+        return [*args, '--', *cmd]
+
+    # Runs on the host, in the new namespaces, with: root, then the overlay
+    # directory (or ""), then host/guest pairs of volumes, then --, then the
+    # command to run in the container
+    _UNSHARE_SCRIPT = """
+root=$1; upper=$2; shift 2
+if [ -n "$upper" ]; then
+    mount -t overlay overlay -o "lowerdir=$root,upperdir=$upper/upper,workdir=$upper/work" "$upper/root"
+    root=$upper/root
+fi
+mkdir -p "$root/dev" "$root/proc"
+mount --rbind /dev "$root/dev"
+mount -t proc proc "$root/proc"
+while [ "$1" != -- ]; do
+    mkdir -p "$root$2"
+    mount --bind "$1" "$root$2"
+    shift 2
+done
+shift
+exec chroot "$root" "$@"
+"""
+
+    def _unshare_args(self, cmd, volumes):
+        args = [
+            self.backend.executable,
+            '--mount', '--pid', '--ipc', '--uts', '--fork', '--kill-child',
+            '--', 'sh', '-c', self._UNSHARE_SCRIPT, 'sh', str(self.root), self.upper or '',
+        ]
+        for host, guest in _volume_pairs(volumes):
+            args += [host, guest]
+        # chroot keeps the host's environment, so swap in the container's
+        env = [f"{k}={v}" for k, v in self._environ().items()]
+        return [
+            *args, '--',
+            '/usr/bin/env', '-i', *env,
+            '/bin/sh', '-c', 'cd "$0" && exec "$@"', self.container.workdir or '/',
+            *cmd,
+        ]
+
+    def _exec_args(self, cmd, volumes):
+        """
+        The host command line running cmd in the container, and its environment.
+        """
+        if self.backend.sandbox == 'bwrap':
+            return self._bwrap_args(cmd, volumes), self._environ()
+        else:
+            return self._unshare_args(cmd, volumes), None
+
+    async def popen(self, cmd, *, volumes=None, stdin=None, stdout=None, stderr=None):
+        """
+        Runs a command, returning the Process
+        """
+        fullcmd, env = self._exec_args(cmd, volumes)
+        LOG.debug("Run %s", fullcmd)
+        return await asyncio.create_subprocess_exec(
+            *fullcmd, stdin=stdin, stdout=stdout, stderr=stderr, env=env,
+        )
+
+    async def popen_with_protocol(self, protocol, cmd, *, volumes=None, **opts):
+        """
+        Runs a command using the given Protocol factory.
+
+        Returns (transport, protocol)
+        """
+        fullcmd, env = self._exec_args(cmd, volumes)
+        LOG.debug("Run %s (with protocol %r)", fullcmd, protocol)
+        loop = asyncio.get_running_loop()
+        return await loop.subprocess_exec(protocol, *fullcmd, env=env, **opts)
+
+
+class FakeBackend(Backend):
+    """
+    Doesn't use containers at all: runners are served in this process, from
+    whatever modules it can import, connected over socket pairs.
+
+    This is for testing runtimes (and what's built on them) without buildah,
+    root or a container image; the image is ignored, and no WarmPool is used.
+    Only the runner can be run, a zygote doesn't fork, and the manifest's
+    threads setting is ignored (rather than replacing this process's default
+    executor). manifest is used as the bundle's manifest.
+    """
+    def __init__(self, manifest=None):
+        self.manifest = manifest
+
+    async def create(self, image, pool=None):
+        return FakeContainer(image, self.manifest)
+
+
+class _FakeStdin:
+    """
+    The stdin of a _FakeProcess. Closing it asks the process to exit.
+    """
+    def __init__(self, closed):
+        self._closed = closed
+
+    def close(self):
+        self._closed.set()
+
+
+class _FakeProcess:
+    """
+    Looks like an asyncio.subprocess.Process, but is a coroutine running in
+    this process.
+
+    body is called with an asyncio.Event that's set when stdin is closed, and
+    the process exits when it returns. Killing it cancels it.
+    """
+    pid = None
+
+    def __init__(self, body, name):
+        self.returncode = None
+        closed = asyncio.Event()
+        self.stdin = _FakeStdin(closed)
+        self._task = asyncio.create_task(self._run(body(closed)), name=name)
+
+    async def _run(self, coro):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            self.returncode = -signal.SIGKILL
+        except Exception:
+            LOG.exception("Error in fake runner")
+            self.returncode = 1
+        else:
+            self.returncode = 0
+
+    async def wait(self):
+        await asyncio.shield(self._task)
+        return self.returncode
+
+    def kill(self):
+        self._task.cancel()
+
+    terminate = kill
+
+    def send_signal(self, sig):
+        self.kill()
+
+
+class _FakeSubprocessTransport(asyncio.SubprocessTransport):
+    """
+    The SubprocessTransport of a _FakeProcess whose stdin and stdout are one
+    end of a socket pair.
+    """
+    def __init__(self, process, protocol):
+        self._process = process
+        self._protocol = protocol
+        self._pipe = None
+
+    def get_pid(self):
+        return self._process.pid
+
+    def get_returncode(self):
+        return self._process.returncode
+
+    def get_pipe_transport(self, fd):
+        return self._pipe if fd == 0 else None
+
+    def is_closing(self):
+        return self._pipe is None or self._pipe.is_closing()
+
+    def close(self):
+        # Like a real subprocess transport, this kills the process
+        if self._pipe is not None:
+            self._pipe.close()
+        self._process.kill()
+
+    def kill(self):
+        self._process.kill()
+
+    terminate = kill
+
+    def send_signal(self, signal):
+        self._process.kill()
+
+
+class _FakePipeProtocol(asyncio.Protocol):
+    """
+    Relays between the socket of a _FakeSubprocessTransport and its
+    SubprocessProtocol.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+
+    def connection_made(self, pipe):
+        self.transport._pipe = pipe
+        self.transport._protocol.connection_made(self.transport)
+
+    def data_received(self, data):
+        self.transport._protocol.pipe_data_received(1, data)
+
+    def pause_writing(self):
+        self.transport._protocol.pause_writing()
+
+    def resume_writing(self):
+        self.transport._protocol.resume_writing()
+
+    def connection_lost(self, exc):
+        protocol = self.transport._protocol
+        protocol.pipe_connection_lost(0, exc)
+        protocol.pipe_connection_lost(1, exc)
+
+        def exited(_):
+            protocol.process_exited()
+            protocol.connection_lost(None)
+        self.transport._process._task.add_done_callback(exited)
+
+
+class _FakeServerProtocol(urp.server.ServerStreamProtocol):
+    """
+    Serves a connection to a fake runner. Losing the connection stops its
+    calls, as the runner exiting would have.
+    """
+    def __init__(self, router):
+        super().__init__(router)
+        self._running = set()
+
+    @contextlib.contextmanager
+    def _track(self):
+        task = asyncio.current_task()
+        self._running.add(task)
+        try:
+            yield
+        finally:
+            self._running.discard(task)
+
+    async def urp_new_channel(self, channel_id, msg):
+        if self._finished.is_set():
+            # Came in just before the connection was lost
+            return
+        with self._track():
+            await super().urp_new_channel(channel_id, msg)
+
+    async def _method_task(self, send, name, kwargs):
+        with self._track():
+            await super()._method_task(send, name, kwargs)
+
+    def connection_lost(self, exc):
+        # Before the channels hear of it, which urp doesn't handle well
+        for task in self._running:
+            task.cancel()
+        super().connection_lost(exc)
+
+    async def stopped(self):
+        """
+        Waits for the connection to be lost, and its calls to stop.
+        """
+        await self.finished()
+        while self._running:
+            await asyncio.wait(list(self._running))
+
+
+class FakeContainer:
+    """
+    A container of a FakeBackend.
+    """
+    def __init__(self, image, manifest=None):
+        self.image = image
+        self.manifest = manifest
+
+    def __str__(self):
+        return f"fake-{self.image}"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def _server(self, cmd, volumes):
+        """
+        Makes the server a runner command line would, with the volumes' guest
+        paths mapped to their host paths.
+        """
+        if len(cmd) < 2 or os.path.basename(cmd[1]) != '__runner__.py':
+            raise ValueError(f"The fake backend can only run the runner, not {cmd!r}")
+        volumes = list(_volume_pairs(volumes))
+
+        def host_path(arg):
+            for host, guest in volumes:
+                if arg == guest or arg.startswith(guest + '/'):
+                    return host + arg[len(guest):]
+            return arg
+
+        args = parse_args([host_path(arg) for arg in cmd[2:]])
+        for name in args.preload:
+            importlib.import_module(name)
+        server = UrpServer(
+            manifest=self.manifest,
+            overrides=args.functions,
+            side_channel=SideChannel(args.payloads, args.payload_threshold),
+        )
+        return server, args.listen or args.zygote
+
+    @staticmethod
+    def _stop(server):
+        """
+        Does what the runner exiting would: stops the calls in progress.
+        """
+        for task in list(server.calls.values()):
+            task.cancel()
+        server.close()
+
+    async def popen(self, cmd, *, volumes=None, stdin=None, stdout=None, stderr=None):
+        """
+        Starts serving a runner listening on a socket, returning something
+        that looks like its Process.
+        """
+        server, path = self._server(cmd, volumes)
+        if path is None:
+            raise ValueError("The fake backend only runs stdio runners with popen_with_protocol()")
+
+        async def listen(closed):
+            loop = asyncio.get_running_loop()
+            protocols = []
+
+            def connected():
+                proto = _FakeServerProtocol(server)
+                protocols.append(proto)
+                return proto
+
+            if os.path.exists(path):
+                os.unlink(path)
+            listener = await loop.create_unix_server(connected, path)
+            try:
+                await closed.wait()
+            finally:
+                listener.close()
+                # Exiting would have taken the connections with it
+                for proto in protocols:
+                    await proto.close()
+                for proto in protocols:
+                    await proto.stopped()
+                self._stop(server)
+                os.unlink(path)
+
+        return _FakeProcess(listen, name=f"fake-runner-{path}")
+
+    async def popen_with_protocol(self, protocol, cmd, *, volumes=None, **opts):
+        """
+        Starts serving a runner over stdio, connected to the given
+        SubprocessProtocol factory.
+
+        Returns (transport, protocol)
+        """
+        server, _ = self._server(cmd, volumes)
+        ours, theirs = socket.socketpair()
+
+        async def serve(closed):
+            loop = asyncio.get_running_loop()
+            _, proto = await loop.connect_accepted_socket(
+                lambda: _FakeServerProtocol(server), sock=theirs,
+            )
+            try:
+                await proto.stopped()
+            finally:
+                self._stop(server)
+
+        process = _FakeProcess(serve, name=f"fake-runner-{self.image}")
+        transport = _FakeSubprocessTransport(process, protocol())
+        loop = asyncio.get_running_loop()
+        await loop.connect_accepted_socket(lambda: _FakePipeProtocol(transport), sock=ours)
+        return transport, transport._protocol
+
+
+#: The backends, by the names they can be chosen with
+BACKENDS = {
+    'buildah': BuildahBackend,
+    'direct': DirectBackend,
+    'fake': FakeBackend,
+}
@@ -3,13 +3,16 @@ An API for buildah
 """
 import asyncio
 from asyncio import subprocess
+import collections
 import contextlib
 import copy
+import dataclasses
 import json
 import logging
 import pathlib
 import shutil
 from subprocess import CalledProcessError
+import time
 import urllib.request
 import typing
 
@@ -17,24 +20,85 @@ from .utils import AsyncInit
 
 LOG = logging.getLogger(__name__)
 
+#: The most buildah processes to run at once. They mostly just contend for
+#: the storage lock beyond a few.
+MAX_PROCESSES = 4
 
-async def _buildah_out(*cmd, **opts):
+
+@dataclasses.dataclass
+class CommandStats:
+    """
+    How a buildah subcommand has been doing.
+    """
+    #: How many times it's been run
+    calls: int = 0
+    #: How many of those failed
+    errors: int = 0
+    #: Seconds spent waiting for a turn to run it, in total
+    wait_time: float = 0.0
+    #: Seconds spent running it, in total
+    run_time: float = 0.0
+    #: The most seconds a single run took
+    max_time: float = 0.0
+
+
+#: Stats of every _buildah_out(), by subcommand
+STATS: typing.Dict[str, CommandStats] = collections.defaultdict(CommandStats)
+
+_limiter = None
+
+
+def _semaphore():
+    """
+    The limit on buildah processes, for the running loop.
+    """
+    global _limiter
+    loop = asyncio.get_running_loop()
+    if _limiter is None or _limiter[0] is not loop:
+        _limiter = loop, asyncio.Semaphore(MAX_PROCESSES)
+    return _limiter[1]
+
+
+def stats():
+    """
+    The stats of buildah subcommands, as a JSON-able dict.
+    """
+    return {name: dataclasses.asdict(s) for name, s in STATS.items()}
+
+
+async def _buildah_out(*cmd, limited=True, **opts):
     """
     Calls buildah, returning the output.
 
+    Waits for a turn if MAX_PROCESSES are already running, unless limited is
+    False.
+
     Returns a str of the stdout or raises a CalledProcessError.
     """
     opts.setdefault('stdout', subprocess.PIPE)
-    LOG.debug("Run %s", ['buildah', *cmd])
-    proc = await asyncio.create_subprocess_exec(
-        'buildah', *cmd, **opts,
-    )
-    stdout, stderr = await proc.communicate()
+    cmd_stats = STATS[cmd[0]]
+    queued = time.monotonic()
+    async with _semaphore() if limited else contextlib.AsyncExitStack():
+        started = time.monotonic()
+        cmd_stats.wait_time += started - queued
+        LOG.debug("Run %s", ['buildah', *cmd])
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                'buildah', *cmd, **opts,
+            )
+            stdout, stderr = await proc.communicate()
+        finally:
+            elapsed = time.monotonic() - started
+            cmd_stats.calls += 1
+            cmd_stats.run_time += elapsed
+            cmd_stats.max_time = max(cmd_stats.max_time, elapsed)
+    LOG.debug("buildah %s took %.3fs (waited %.3fs)", cmd[0], elapsed, started - queued)
     if stdout is not None:
         stdout = stdout.decode('utf-8')
     if stderr is not None:
         stderr = stderr.decode('utf-8')
     if proc.returncode:
+        cmd_stats.errors += 1
         raise CalledProcessError(
             proc.returncode, ['buildah', *cmd],
             output=stdout, stderr=stderr,
@@ -83,6 +147,14 @@ def _join_shellwords(seq):
 
 class Container(metaclass=AsyncInit):
     _id: str
+    #: Where the container's filesystem is mounted on the host, if it is
+    mountpoint: typing.Optional[pathlib.Path] = None
+    #: The last result of inspect(), until something changes it
+    _inspected: typing.Optional[dict] = None
+    _config_lock: typing.Optional[asyncio.Lock] = None
+
+    #: The attributes that are written back with `buildah config`
+    _CONFIG_ATTRS = ('environ', 'command', 'entrypoint', 'labels', 'volumes', 'workdir')
 
     environ: typing.Dict[str, str]
     command: typing.List[str]
@@ -105,9 +177,18 @@ class Container(metaclass=AsyncInit):
         if mounts:
             for mntinfo in mounts:
                 args += ['--volume', ':'.join(map(str, mntinfo))]
-        stdout = await _buildah_out('from', *args, str(image))
+        if isinstance(image, Image):
+            image_id = str(image)
+        else:
+            # Start from the local image if there is one, rather than have
+            # buildah resolve the name
+            image_id = await INDEX.find(str(image))
+        stdout = await _buildah_out('from', *args, image_id or str(image))
         self._id = stdout.strip()
-        await self._init_config()
+        if image_id is None:
+            # buildah pulled it
+            await INDEX.update(str(image))
+        await self._init_config(image_id)
 
     @classmethod
     def _from_id_only(cls, id):
@@ -117,16 +198,23 @@ class Container(metaclass=AsyncInit):
         self._init_config()
         return self
 
-    async def _init_config(self):
+    async def _init_config(self, image_id=None):
         """
         Initialize the config attrs
+
+        A new container has the config of its image, so if that's been seen
+        before, there's no need to inspect.
         """
-        info = await self.inspect()
-        if info['Config']:
-            kinda_config = json.loads(info['Config'])
-            config = kinda_config['config']  # Might be 'container_config'??
-        else:
-            config = {}
+        config = copy.deepcopy(_image_configs.get(image_id))
+        if config is None:
+            info = await self.inspect()
+            if info['Config']:
+                kinda_config = json.loads(info['Config'])
+                config = kinda_config['config']  # Might be 'container_config'??
+            else:
+                config = {}
+            if image_id is not None:
+                _image_configs[image_id] = copy.deepcopy(config)
         self.environ = dict(
             item.split('=', 1)
             for item in config.get('Env') or {}
@@ -146,7 +234,10 @@ class Container(metaclass=AsyncInit):
         """
         Snapshot config for future comparison
         """
-        self._snapshot = copy.deepcopy(vars(self))
+        self._snapshot = self._copy_config()
+
+    def _copy_config(self):
+        return copy.deepcopy({name: getattr(self, name) for name in self._CONFIG_ATTRS})
 
     def _produce_config_args(self):
         """
@@ -182,13 +273,32 @@ class Container(metaclass=AsyncInit):
     async def _commit_config(self):
         """
         Commit any config changes to buildah
+
+        All the changes made since the last commit go in one `buildah config`.
+        Concurrent callers wait for it, rather than each running their own.
         """
+        async with self._lock():
+            await self._apply_config()
+
+    def _lock(self):
+        """
+        Serializes config changes and inspection.
+        """
+        if self._config_lock is None:
+            self._config_lock = asyncio.Lock()
+        return self._config_lock
+
+    async def _apply_config(self):
         if not hasattr(self, '_snapshot'):
             return
         args = self._produce_config_args()
-        if args:
-            await _buildah_out('config', *args, self._id)
-            self._snapshot_config()
+        if not args:
+            return
+        # Changes made while buildah runs are left for next time
+        snapshot = self._copy_config()
+        await _buildah_out('config', *args, self._id)
+        self._snapshot = snapshot
+        self._inspected = None
 
     async def __aenter__(self):
         return self
@@ -199,15 +309,42 @@ class Container(metaclass=AsyncInit):
     async def inspect(self):
         """
         Return some metadata about the container
+
+        The result is cached until the container's config or mounts change.
         """
-        await self._commit_config()
-        stdout = await _buildah_out('inspect', '--type', 'container', self._id)
-        return json.loads(stdout)
+        async with self._lock():
+            await self._apply_config()
+            if self._inspected is None:
+                stdout = await _buildah_out('inspect', '--type', 'container', self._id)
+                self._inspected = json.loads(stdout)
+            return copy.deepcopy(self._inspected)
 
     async def commit(self):
         await self._commit_config()
-        stdout = await _buildah_out('commit', self._id)
-        return Image._from_id_only(stdout.strip())
+        stdout = await _buildah_out('commit', '--quiet', self._id)
+        image = Image._from_id_only(stdout.strip())
+        await INDEX.update(str(image))
+        return image
+
+    async def mount_root(self):
+        """
+        Mounts the container's filesystem onto the host, returning the mount
+        point as a pathlib.Path.
+
+        It stays mounted until unmount() is called or the container is removed.
+        """
+        stdout = await _buildah_out('mount', self._id)
+        self.mountpoint = pathlib.Path(stdout.strip())
+        self._inspected = None
+        return self.mountpoint
+
+    async def unmount(self):
+        """
+        Undoes mount_root().
+        """
+        await _buildah_out('umount', self._id)
+        self.mountpoint = None
+        self._inspected = None
 
     @contextlib.asynccontextmanager
     async def mount(self):
@@ -216,11 +353,17 @@ class Container(metaclass=AsyncInit):
 
         The context manager returns a pathlib.PurePath, which points to the mount
         point.
+
+        If the container is already mounted, it's left that way.
         """
-        stdout = await _buildah_out('mount', self._id)
-        path = stdout.strip()
-        yield pathlib.Path(path)
-        await _buildah_out('umount', self._id)
+        if self.mountpoint is not None:
+            yield self.mountpoint
+            return
+        path = await self.mount_root()
+        try:
+            yield path
+        finally:
+            await self.unmount()
 
     async def copy_in(self, src, dst):
         """
@@ -300,9 +443,11 @@ class Container(metaclass=AsyncInit):
             'text': text,
         }
 
+        # Runs can take minutes (installing packages, say), and don't hold the
+        # storage lock while they do, so they don't take a turn
         return await _buildah_out(
             'run', *args, '--', self._id, *cmd,
-            **opts,
+            limited=False, **opts,
         )
 
 
@@ -372,8 +517,14 @@ class ImageNotFoundError(Exception):
     """
 
 
+#: Parsed configs of images, by ID, so containers of them needn't inspect
+_image_configs = {}
+
+
 class Image(metaclass=AsyncInit):
     _id: str
+    #: The last result of inspect(), until the image is tagged
+    _inspected: typing.Optional[dict] = None
 
     def __init__(self, ident):
         pass
@@ -406,19 +557,27 @@ class Image(metaclass=AsyncInit):
         If no tag is given, :latest is used.
         """
         await _buildah_out('tag', self._id, tag)
+        self._inspected = None
+        INDEX.tag(self._id, tag)
 
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await _buildah_out('rmi', self._id, stdout=subprocess.DEVNULL)
+        _image_configs.pop(self._id, None)
+        INDEX.remove(self._id)
 
     async def inspect(self):
         """
         Return some metadata about the image
+
+        Images don't change (other than their names), so this is cached.
         """
-        stdout = await _buildah_out('inspect', '--type', 'image', self._id)
-        return json.loads(stdout)
+        if self._inspected is None:
+            stdout = await _buildah_out('inspect', '--type', 'image', self._id)
+            self._inspected = json.loads(stdout)
+        return copy.deepcopy(self._inspected)
 
     @classmethod
     async def list(cls, name=None, *, all=False):
@@ -441,17 +600,32 @@ class Image(metaclass=AsyncInit):
             yield img
 
     @classmethod
-    async def _resolve(cls, id):
-        if any(img['id'] == id for img in cls.list()):
+    async def find(cls, name):
+        """
+        Looks for an image in local storage by name or ID, without pulling.
+
+        Returns None if there's no such image. This goes by the INDEX, so
+        doesn't run buildah once that's loaded.
+        """
+        id = await INDEX.find(name)
+        if id is None:
+            return None
+        return cls._from_id_only(id)
+
+    @classmethod
+    async def _resolve(cls, ident):
+        id = await INDEX.find(ident)
+        if id is not None:
             return id
 
-        # TODO: Use `buildah inspect` to test if it's available locally.
         try:
-            stdout = await _buildah_out('pull', '--quiet', id, stderr=subprocess.DEVNULL)
-        except subprocess.CalledProcessError as exc:
-            raise ImageNotFoundError(f"Could not find image {id}") from exc
+            stdout = await _buildah_out('pull', '--quiet', ident, stderr=subprocess.DEVNULL)
+        except CalledProcessError as exc:
+            raise ImageNotFoundError(f"Could not find image {ident}") from exc
         else:
-            return stdout.strip()
+            id = stdout.strip()
+            await INDEX.update(id)
+            return id
 
     @classmethod
     async def pull(cls, name):
@@ -459,9 +633,182 @@ class Image(metaclass=AsyncInit):
         Pulls down the given image.
         """
         try:
-            stdout = await _buildah_out('pull', name)
-        except subprocess.CalledProcessError as exc:
+            stdout = await _buildah_out('pull', '--quiet', name)
+        except CalledProcessError as exc:
             raise ImageNotFoundError(f"Could not find image {name}") from exc
         else:
             id = stdout.strip()
+            await INDEX.update(id)
             return cls._from_id_only(id)
+
+
+#: What buildah images' human readable sizes are in
+_SIZE_UNITS = {'B': 1, 'kB': 1e3, 'KB': 1e3, 'MB': 1e6, 'GB': 1e9, 'TB': 1e12, 'PB': 1e15}
+
+
+def _parse_size(size):
+    """
+    Parses an image size from `buildah images --json` ("1.234 GB"), in bytes.
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    number, _, unit = size.strip().partition(' ')
+    return int(float(number) * _SIZE_UNITS.get(unit.strip(), 1))
+
+
+def _with_tag(name):
+    if '@' not in name and ':' not in name.rpartition('/')[2]:
+        name += ':latest'
+    return name
+
+
+def _is_qualified(name):
+    """
+    Whether an image name starts with a registry.
+    """
+    first, _, rest = name.partition('/')
+    return bool(rest) and ('.' in first or ':' in first or first == 'localhost')
+
+
+def _qualify(name):
+    """
+    The name buildah gives an image tagged with name.
+    """
+    name = _with_tag(name)
+    return name if _is_qualified(name) else f'localhost/{name}'
+
+
+def _name_candidates(name):
+    """
+    The names buildah might list an image reference under: with the default
+    tag, and qualified like buildah does short names.
+    """
+    name = _with_tag(name)
+    if _is_qualified(name):
+        yield name
+    else:
+        yield f'localhost/{name}'
+        yield f'docker.io/{name}' if '/' in name else f'docker.io/library/{name}'
+
+
+class ImageIndex:
+    """
+    The images in local storage, listed once with `buildah images` and then
+    kept up to date as images are committed, pulled, tagged and removed
+    through this module. Looking an image up doesn't run buildah.
+
+    Images changed by anything else aren't noticed until refresh().
+    """
+    def __init__(self):
+        self._images = None
+        self._names = {}
+        self._sizes = {}
+        self._loading = None
+
+    async def load(self):
+        """
+        List the local images, if that hasn't been done yet.
+        """
+        if self._images is not None:
+            return
+        if self._loading is None or self._loading.done():
+            self._loading = asyncio.ensure_future(self.refresh())
+        await asyncio.shield(self._loading)
+
+    async def refresh(self):
+        """
+        List the local images again.
+        """
+        stdout = await _buildah_out('images', '--json')
+        self._images, self._names, self._sizes = {}, {}, {}
+        for info in json.loads(stdout or 'null') or []:
+            self._add(info)
+        LOG.debug("Indexed %d local images", len(self._images))
+
+    async def update(self, ident):
+        """
+        Pick up a single image (by name or ID) that's been added or changed.
+        """
+        await self.load()
+        try:
+            stdout = await _buildah_out('images', '--json', ident)
+        except CalledProcessError:
+            LOG.exception("Error indexing image %s", ident)
+            return
+        for info in json.loads(stdout or 'null') or []:
+            self._add(info)
+
+    def _add(self, info):
+        id = info['id']
+        self._images[id] = set()
+        self._sizes[id] = _parse_size(info.get('size') or 0)
+        for name in info.get('names') or []:
+            self.tag(id, name)
+
+    def tag(self, id, name):
+        """
+        Record that an image now has a name (which no other image has).
+        """
+        if self._images is None or id not in self._images:
+            return
+        name = _qualify(name)
+        old = self._names.get(name)
+        if old is not None and old != id:
+            self._images[old].discard(name)
+        self._names[name] = id
+        self._images[id].add(name)
+
+    def remove(self, id):
+        """
+        Record that an image has been removed.
+        """
+        if self._images is None:
+            return
+        for name in self._images.pop(id, ()):
+            self._names.pop(name, None)
+        self._sizes.pop(id, None)
+
+    def lookup(self, ident):
+        """
+        The ID of the image with the given name or ID, or None if it isn't
+        known.
+        """
+        if not self._images:
+            return None
+        if ident in self._images:
+            return ident
+        for name in _name_candidates(ident):
+            if name in self._names:
+                return self._names[name]
+        if len(ident) >= 12 and all(c in '0123456789abcdef' for c in ident):
+            matches = [id for id in self._images if id.startswith(ident)]
+            if len(matches) == 1:
+                return matches[0]
+        return None
+
+    async def find(self, ident):
+        """
+        Like lookup(), loading the index first if needed.
+        """
+        await self.load()
+        return self.lookup(ident)
+
+    def named(self, repository):
+        """
+        Yields (id, name) for each name in the given repository, like
+        "localhost/microfaas-bundle".
+        """
+        for name, id in list(self._names.items()):
+            if name.startswith(f'{repository}:'):
+                yield id, name
+
+    def size(self, id):
+        """
+        How big the image is in bytes (counting the layers it shares with
+        others), or 0 if it isn't known.
+        """
+        return self._sizes.get(id, 0)
+
+
+#: The local images
+INDEX = ImageIndex()
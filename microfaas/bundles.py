@@ -0,0 +1,198 @@
+"""
+Handling of bundle sources: zip files of code to run.
+"""
+import asyncio
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import typing
+import zipfile
+
+import aiofiles
+
+from .__runner__ import MANIFEST
+
+LOG = logging.getLogger(__name__)
+
+#: A file in a bundle listing extra packages to install
+REQUIREMENTS = 'requirements.txt'
+
+#: How much to read or write at a time
+CHUNK_SIZE = 1024 * 1024
+
+
+@dataclasses.dataclass
+class BundleSource:
+    """
+    A bundle on disk, along with its content hash.
+    """
+    #: Where the zip is
+    path: pathlib.Path
+    #: The sha256 of the zip, as hex
+    digest: str
+    #: Whether path is a spool file that should be deleted when done
+    temporary: bool = False
+    #: The bundle's manifest, if it has one
+    manifest: typing.Optional[dict] = None
+
+    def cleanup(self):
+        """
+        Delete the spool file, if there is one.
+        """
+        if self.temporary:
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _spool_file(src, dst):
+    """
+    Copy a file-like object to a path, hashing as it goes.
+    """
+    h = hashlib.sha256()
+    with open(dst, 'wb') as f:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+            f.write(chunk)
+    return h.hexdigest()
+
+
+async def ingest(source):
+    """
+    Get a bundle onto disk, hashing it along the way, without holding the
+    whole thing in memory.
+
+    source may be a path, bytes, a (binary) file-like object, or an async
+    iterable of bytes (like a request body).
+    """
+    loop = asyncio.get_running_loop()
+    if isinstance(source, (str, os.PathLike)):
+        path = pathlib.Path(source)
+        digest = await loop.run_in_executor(None, _hash_file, path)
+        bsource = BundleSource(path, digest)
+    else:
+        bsource = await _spool(source)
+    try:
+        bsource.manifest = await loop.run_in_executor(None, read_manifest, bsource.path)
+    except BaseException:
+        bsource.cleanup()
+        raise
+    return bsource
+
+
+def read_manifest(path):
+    """
+    Reads the manifest out of a bundle, or returns None if it doesn't have one.
+    """
+    with zipfile.ZipFile(path) as zf:
+        try:
+            data = zf.read(MANIFEST)
+        except KeyError:
+            return None
+    return json.loads(data)
+
+
+async def _spool(source):
+    """
+    Writes a non-path source to a temporary file.
+    """
+    loop = asyncio.get_running_loop()
+
+    fd, spool = tempfile.mkstemp(prefix='microfaas-', suffix='.zip')
+    os.close(fd)
+    spool = pathlib.Path(spool)
+    try:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            digest = hashlib.sha256(source).hexdigest()
+            async with aiofiles.open(spool, 'wb') as f:
+                await f.write(source)
+        elif hasattr(source, 'read'):
+            digest = await loop.run_in_executor(None, _spool_file, source, spool)
+        else:
+            h = hashlib.sha256()
+            async with aiofiles.open(spool, 'wb') as f:
+                async for chunk in source:
+                    h.update(chunk)
+                    await f.write(chunk)
+            digest = h.hexdigest()
+    except BaseException:
+        spool.unlink()
+        raise
+    return BundleSource(spool, digest, temporary=True)
+
+
+def _member_path(root, name):
+    """
+    Where a zip member should go under root, sanitized the way
+    ZipFile.extract() does it.
+    """
+    parts = [
+        p for p in name.replace('\\', '/').split('/')
+        if p not in ('', '.', '..')
+    ]
+    return root.joinpath(*parts)
+
+
+def _extract_members(path, root, members):
+    # Every thread gets its own ZipFile, since they share a file position
+    with zipfile.ZipFile(path) as zf:
+        for info in members:
+            with zf.open(info) as src, open(_member_path(root, info.filename), 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def extract_source(source, root, *, workers=None):
+    """
+    Extracts a BundleSource into the given directory, spreading the files
+    across a pool of threads.
+
+    Returns True if the bundle has a requirements.txt.
+    """
+    root = pathlib.Path(root)
+    with zipfile.ZipFile(source.path) as zf:
+        infos = zf.infolist()
+
+    # Make all the directories up front, so the threads don't race on them
+    files = []
+    for info in infos:
+        target = _member_path(root, info.filename)
+        if info.is_dir():
+            target.mkdir(parents=True, exist_ok=True)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            files.append(info)
+
+    # Deal out the files largest first, so the threads get similar amounts
+    workers = workers or os.cpu_count() or 1
+    shares = [[] for _ in range(workers)]
+    sizes = [0] * workers
+    for info in sorted(files, key=lambda i: i.file_size, reverse=True):
+        idx = sizes.index(min(sizes))
+        shares[idx].append(info)
+        sizes[idx] += info.file_size
+
+    with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="extract") as pool:
+        futures = [
+            pool.submit(_extract_members, source.path, root, share)
+            for share in shares if share
+        ]
+        for fut in concurrent.futures.as_completed(futures):
+            fut.result()
+
+    LOG.debug("Extracted %d files from %s", len(files), source.path)
+    return any(info.filename == REQUIREMENTS for info in infos)
@@ -1,13 +1,15 @@
 """
 Quart app for managing things.
 """
-from quart import Blueprint, current_app
+from quart import Blueprint, current_app, request
 
 blueprint = Blueprint('config', __name__)
 
 @blueprint.route("/<slug>", methods=["POST"])
-def deploy(slug):
+async def deploy(slug):
     """
     Deploy bundle
     """
-    raise NotImplementedError
+    # Stream the body, so big bundles aren't held in memory
+    await current_app.rt_man.deploy(slug, request.body)
+    return {"deployed": slug}
@@ -0,0 +1,254 @@
+"""
+Builds and caches the images that runtimes start from.
+"""
+import asyncio
+import collections
+import hashlib
+import importlib.resources
+import logging
+import pathlib
+
+from .buildah import INDEX, Container, Image
+from .bundles import REQUIREMENTS, extract_source
+
+LOG = logging.getLogger(__name__)
+
+#: The image the runner image is built on
+RUNNER_BASE = 'python:3'
+#: What the runner needs installed
+RUNNER_REQUIREMENTS = ['unnamed-rpc']
+#: The name runner images are tagged with; the tag is the cache key
+RUNNER_IMAGE = 'localhost/microfaas-runner'
+#: The name bundle images are tagged with; the tag is the bundle's hash
+BUNDLE_IMAGE = 'localhost/microfaas-bundle'
+
+
+def _pip_install(wheelhouse):
+    """
+    The start of a pip install command, and the volumes it needs.
+    """
+    cmd = ['pip', 'install', '--no-cache-dir']
+    volumes = None
+    if wheelhouse is not None:
+        cmd += ['--no-index', '--find-links', '/wheelhouse']
+        volumes = [(str(wheelhouse.resolve()), '/wheelhouse', 'ro')]
+    return cmd, volumes
+
+
+class RunnerImage:
+    """
+    The image with python, the runner, and its dependencies, ready for a bundle
+    to be dropped into /app.
+
+    It's built once and tagged with a hash of everything that goes into it, so
+    it's only rebuilt when the runner or its dependencies change. Runner
+    images with any other tag are then removed.
+
+    If a wheelhouse (a directory of wheels) is given, dependencies are
+    installed from it instead of the network.
+    """
+    def __init__(self, *, wheelhouse=None):
+        self.wheelhouse = pathlib.Path(wheelhouse) if wheelhouse is not None else None
+        self._lock = asyncio.Lock()
+        self._image = None
+
+    def key(self):
+        """
+        Hash of the inputs to the image.
+        """
+        h = hashlib.sha256()
+        h.update(RUNNER_BASE.encode('utf-8'))
+        for req in RUNNER_REQUIREMENTS:
+            h.update(b'\0' + req.encode('utf-8'))
+        h.update(b'\0' + importlib.resources.read_binary('microfaas', '__runner__.py'))
+        if self.wheelhouse is not None:
+            for wheel in sorted(self.wheelhouse.iterdir()):
+                h.update(b'\0' + wheel.name.encode('utf-8'))
+        return h.hexdigest()[:16]
+
+    async def get(self):
+        """
+        Get the Image, building it if needed.
+        """
+        async with self._lock:
+            if self._image is None:
+                tag = f"{RUNNER_IMAGE}:{self.key()}"
+                self._image = await Image.find(tag)
+                if self._image is None:
+                    LOG.info("Building runner image %s", tag)
+                    self._image = await self._build()
+                    await self._image.add_tag(tag)
+                await self._remove_old()
+            return self._image
+
+    async def _remove_old(self):
+        """
+        Remove the runner images built for other keys, which are left behind
+        whenever the runner or its dependencies change.
+        """
+        current = str(self._image)
+        old = {id: name for id, name in INDEX.named(RUNNER_IMAGE) if id != current}
+        for id, name in old.items():
+            LOG.info("Removing old runner image %s", name)
+            try:
+                await Image._from_id_only(id).__aexit__(None, None, None)
+            except Exception:
+                # Bundle images built on it, say, keep it in use
+                LOG.warning("Error removing old runner image %s", name, exc_info=True)
+
+    async def _build(self):
+        cont = await Container(RUNNER_BASE)
+        async with cont:
+            cmd, volumes = _pip_install(self.wheelhouse)
+            await cont.run([*cmd, *RUNNER_REQUIREMENTS], volumes=volumes, stdout=None)
+
+            with importlib.resources.path('microfaas', '__runner__.py') as src:
+                await cont.copy_in(src, '/__runner__.py')
+
+            await cont.run(['mkdir', '-p', '/app'], stdout=None)
+            cont.workdir = '/app'
+            return await cont.commit()
+
+
+class BundleCache:
+    """
+    Images of the runner image with a bundle extracted into it and the
+    bundle's requirements installed, keyed by the hash of the bundle.
+
+    Deploying the same bytes again, adding replicas, or restarting the server
+    reuses the image instead of extracting and installing again.
+
+    Images are reference counted while runtimes use them. Once there are more
+    than max_images, or they take more than max_bytes of disk, the least
+    recently used unreferenced ones are removed. An image's disk usage is
+    taken to be how much bigger it is than the runner image, which is shared.
+
+    If a WarmPool is given, new images are built in a spare runner container
+    from it, and that container is handed back to the pool afterwards as a
+    ready container of the new image.
+    """
+    def __init__(self, runner_image, *, max_images=32, max_bytes=None, pool=None):
+        self.runner_image = runner_image
+        self.pool = pool
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self._images = collections.OrderedDict()
+        self._refs = collections.Counter()
+        self._building = {}
+
+    async def load(self):
+        """
+        Pick up bundle images left by a previous run.
+        """
+        await INDEX.load()
+        for id, name in INDEX.named(BUNDLE_IMAGE):
+            key = name.rpartition(':')[2]
+            self._images[key] = Image._from_id_only(id)
+            self._images.move_to_end(key, last=False)
+
+    async def acquire(self, source):
+        """
+        Get the image for a BundleSource, building it if needed.
+
+        Returns (key, Image). Call release(key) when it's no longer used.
+        """
+        key = source.digest
+        self._refs[key] += 1
+        try:
+            if key in self._images:
+                self._images.move_to_end(key)
+            else:
+                if key not in self._building:
+                    # Anybody else deploying the same bytes waits on this build
+                    self._building[key] = asyncio.ensure_future(self._build(key, source))
+                    self._building[key].add_done_callback(
+                        lambda _: self._building.pop(key, None)
+                    )
+                self._images[key] = await asyncio.shield(self._building[key])
+        except BaseException:
+            self.release(key)
+            raise
+        await self._evict()
+        return key, self._images[key]
+
+    def release(self, key):
+        """
+        A user of the image is done with it.
+        """
+        self._refs[key] -= 1
+        if self._refs[key] <= 0:
+            del self._refs[key]
+
+    async def _build(self, key, source):
+        loop = asyncio.get_running_loop()
+        base = await self.runner_image.get()
+        LOG.info("Building bundle image %s", key)
+        if self.pool is not None:
+            cont = await self.pool.take(base)
+        else:
+            cont = await Container(base)
+        try:
+            async with cont.mount() as root:
+                has_reqs = await loop.run_in_executor(None, extract_source, source, root)
+            if has_reqs:
+                cmd, volumes = _pip_install(self.runner_image.wheelhouse)
+                await cont.run([*cmd, '-r', f'/{REQUIREMENTS}'], volumes=volumes, stdout=None)
+            image = await cont.commit()
+            await image.add_tag(f"{BUNDLE_IMAGE}:{key}")
+        except:
+            await cont.__aexit__(None, None, None)
+            raise
+
+        if self.pool is not None:
+            # The container now has exactly what the image does
+            self.pool.give(image, cont)
+        else:
+            await cont.__aexit__(None, None, None)
+        return image
+
+    def disk_usage(self, base):
+        """
+        Roughly how many bytes the images take, beyond the base (runner)
+        image they share.
+        """
+        base_size = INDEX.size(str(base))
+        return sum(
+            max(INDEX.size(str(image)) - base_size, 0)
+            for image in self._images.values()
+        )
+
+    async def _evict(self):
+        """
+        Remove least recently used, unreferenced images until within bounds.
+        """
+        base = await self.runner_image.get() if self.max_bytes is not None else None
+        failed = set()
+        while len(self._images) > self.max_images or (
+            base is not None and self.disk_usage(base) > self.max_bytes
+        ):
+            for key, image in self._images.items():
+                if (
+                    not self._refs[key]
+                    and key not in self._building
+                    and key not in failed
+                    # Spares of it are wanted for scaling up
+                    and not (self.pool is not None and self.pool.keeping(image))
+                ):
+                    break
+            else:
+                # Everything's in use
+                return
+            image = self._images.pop(key)
+            LOG.info("Evicting bundle image %s", key)
+            try:
+                if self.pool is not None:
+                    # Left over from building it; they'd keep it from being removed
+                    await self.pool.forget(image)
+                await image.__aexit__(None, None, None)
+            except Exception:
+                LOG.exception("Error removing bundle image %s, will retry", key)
+                # Keep track of it, as least recently used, to try again on
+                # the next eviction
+                failed.add(key)
+                self._images[key] = image
+                self._images.move_to_end(key, last=False)
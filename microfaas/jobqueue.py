@@ -0,0 +1,321 @@
+"""
+The queue of calls waiting on a bundle.
+"""
+import asyncio
+import collections
+import dataclasses
+import enum
+import heapq
+import itertools
+import time
+import typing
+
+_sequence = itertools.count()
+
+
+class StreamStalledError(Exception):
+    """
+    The consumer of a stream stopped taking items
+    """
+
+
+class Overflow(enum.Enum):
+    """
+    What to do with a new call when a bundle's queue is full.
+    """
+    #: Wait for room in the queue
+    BLOCK = 'block'
+    #: Refuse the call with a BundleBusyError
+    REJECT = 'reject'
+    #: Discard a queued call (expired, else oldest of the lowest priority) to make room
+    DROP_OLDEST = 'drop-oldest'
+
+
+@dataclasses.dataclass
+class Job:
+    """
+    A call waiting to be made.
+
+    If the job was created with a future, awaiting the job gives the result of
+    the call (or raises its error).
+    """
+    #: The function to call
+    func: str
+    #: JSON-ish: the body of the event
+    body: typing.Any
+    #: dict[str, JSON-ish]: extra data for the event
+    extras: typing.Dict[str, typing.Any]
+    #: Higher priorities are dispatched first
+    priority: int = 0
+    #: time.monotonic() after which the call is no longer worth making
+    deadline: typing.Optional[float] = None
+    #: Seconds the call may run for, or None for the function's default
+    timeout: typing.Optional[float] = None
+    #: Breaks ties in arrival order
+    seq: int = dataclasses.field(default_factory=lambda: next(_sequence))
+    #: Receives the outcome of the call, if anybody is waiting for it
+    future: typing.Optional[asyncio.Future] = dataclasses.field(default=None, repr=False)
+    #: time.monotonic() when the job was queued
+    enqueued_at: float = dataclasses.field(default_factory=time.monotonic)
+    #: time.monotonic() when the job was sent to a runtime
+    dispatched_at: typing.Optional[float] = None
+    #: time.monotonic() when the job finished, one way or another
+    completed_at: typing.Optional[float] = None
+    #: Identifies the job in the JobStore, if it's been saved there
+    id: typing.Optional[int] = None
+    #: Receives the items of a streaming call
+    stream: typing.Optional['ResultStream'] = dataclasses.field(default=None, repr=False)
+
+    def __await__(self):
+        if self.future is None:
+            raise TypeError("This job has no future to await")
+        return self.future.__await__()
+
+    @property
+    def queue_time(self):
+        """
+        Seconds spent waiting in the queue, or None if never dispatched.
+        """
+        if self.dispatched_at is None:
+            return None
+        return self.dispatched_at - self.enqueued_at
+
+    @property
+    def run_time(self):
+        """
+        Seconds spent being executed, or None if not both dispatched and done.
+        """
+        if self.dispatched_at is None or self.completed_at is None:
+            return None
+        return self.completed_at - self.dispatched_at
+
+    @property
+    def total_time(self):
+        """
+        Seconds from being queued to finishing, or None if not done.
+        """
+        if self.completed_at is None:
+            return None
+        return self.completed_at - self.enqueued_at
+
+    def sort_key(self):
+        """
+        Order of dispatch: priority, then earliest deadline, then arrival.
+        """
+        return (
+            -self.priority,
+            self.deadline if self.deadline is not None else float('inf'),
+            self.seq,
+        )
+
+    def expired(self, now=None):
+        """
+        Whether the deadline has passed.
+        """
+        if self.deadline is None:
+            return False
+        if now is None:
+            now = time.monotonic()
+        return now >= self.deadline
+
+    def set_result(self, result):
+        """
+        Record that the job finished successfully.
+        """
+        self.completed_at = time.monotonic()
+        if self.future is not None and not self.future.done():
+            self.future.set_result(result)
+
+    def set_exception(self, exc):
+        """
+        Record that the job failed or was abandoned.
+        """
+        self.completed_at = time.monotonic()
+        if self.future is not None and not self.future.done():
+            self.future.set_exception(exc)
+
+    def cancel(self):
+        """
+        Record that the job will never be run.
+        """
+        self.completed_at = time.monotonic()
+        if self.future is not None:
+            self.future.cancel()
+
+
+class ResultStream:
+    """
+    The items of a streaming call, as they're produced.
+
+    Use async for to consume them. Once they run out, the call's error (if it
+    failed) is raised. At most size items are held here, so a consumer that
+    falls behind slows the function down.
+
+    Closing the stream (or leaving async with) stops the call early.
+    """
+    def __init__(self, job, size=16):
+        if job.future is None:
+            raise TypeError("A streaming job needs a future")
+        #: The Job producing the items
+        self.job = job
+        #: How many items can be buffered
+        self.size = size
+        #: Whether the consumer has gone away
+        self.closed = False
+        self._items = collections.deque()
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        job.stream = self
+        job.future.add_done_callback(lambda _: self._readable.set())
+
+    async def put(self, item, timeout=None):
+        """
+        Adds an item, waiting for room. Returns False if the consumer is gone,
+        and the item can't be delivered.
+
+        Raises StreamStalledError if there's still no room after timeout
+        seconds.
+        """
+        give_up = time.monotonic() + timeout if timeout is not None else None
+        while len(self._items) >= self.size and not self.closed:
+            self._writable.clear()
+            if give_up is None:
+                await self._writable.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._writable.wait(), give_up - time.monotonic())
+            except asyncio.TimeoutError:
+                raise StreamStalledError(
+                    f"Stream of {self.job.func} took no items for {timeout}s"
+                ) from None
+        if self.closed:
+            return False
+        self._items.append(item)
+        self._readable.set()
+        return True
+
+    def close(self):
+        """
+        Stops consuming, discarding any buffered items.
+        """
+        self.closed = True
+        self._items.clear()
+        self._writable.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            if self.closed:
+                raise StopAsyncIteration
+            if self.job.future.done():
+                # Raises the call's error, if there was one
+                self.job.future.result()
+                raise StopAsyncIteration
+            self._readable.clear()
+            await self._readable.wait()
+        item = self._items.popleft()
+        self._writable.set()
+        return item
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+class JobQueue(asyncio.Queue):
+    """
+    An asyncio.Queue of Jobs, handed out by priority and deadline.
+
+    Its size limit can be changed after creation, and it can discard items to
+    make room.
+    """
+    def _init(self, maxsize):
+        self._queue = []
+
+    def _put(self, job):
+        heapq.heappush(self._queue, (job.sort_key(), job))
+
+    def _get(self):
+        return heapq.heappop(self._queue)[1]
+
+    @property
+    def limit(self):
+        """
+        The most items the queue will hold, or 0 for no limit.
+        """
+        return self.maxsize
+
+    @limit.setter
+    def limit(self, value):
+        self._maxsize = value
+        # The queue may have room for some blocked putters now
+        while self._putters and not self.full():
+            self._wakeup_next(self._putters)
+
+    def drop_oldest(self):
+        """
+        Remove and return a job to make room, marking it as done.
+
+        Expired jobs go first. Otherwise, this is the oldest job of the lowest
+        priority, so that urgent calls aren't shed in favor of background ones.
+
+        Raises asyncio.QueueEmpty if there's nothing to drop.
+        """
+        if not self._queue:
+            raise asyncio.QueueEmpty
+        now = time.monotonic()
+        idx = min(
+            range(len(self._queue)),
+            key=lambda i: (
+                not self._queue[i][1].expired(now),
+                self._queue[i][1].priority,
+                self._queue[i][1].seq,
+            ),
+        )
+        _, job = self._queue.pop(idx)
+        heapq.heapify(self._queue)
+        self.task_done()
+        # Room for a putter
+        self._wakeup_next(self._putters)
+        return job
+
+    def remove(self, job):
+        """
+        Take a particular job back out of the queue, marking it as done.
+
+        Returns False if the job isn't queued (eg, it's already been taken).
+        """
+        for idx, (_, queued) in enumerate(self._queue):
+            if queued is job:
+                break
+        else:
+            return False
+        self._queue.pop(idx)
+        heapq.heapify(self._queue)
+        self.task_done()
+        self._wakeup_next(self._putters)
+        return True
+
+    def restore(self, jobs):
+        """
+        Put back jobs recovered from a previous run, regardless of the limit.
+        """
+        for job in jobs:
+            self._put(job)
+            self._unfinished_tasks += 1
+            self._finished.clear()
+            self._wakeup_next(self._getters)
+
+    def drain(self):
+        """
+        Remove and return all queued jobs, marking them as done.
+        """
+        jobs = []
+        while not self.empty():
+            jobs.append(self.get_nowait())
+            self.task_done()
+        return jobs
@@ -0,0 +1,190 @@
+"""
+Keeps queued jobs on disk, so they survive restarts.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import json
+import logging
+import sqlite3
+import time
+
+from .jobqueue import Job
+
+LOG = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    bundle TEXT NOT NULL,
+    func TEXT NOT NULL,
+    -- JSON, or a BLOB for bytes bodies
+    body TEXT NOT NULL,
+    extras TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    deadline REAL
+)
+"""
+
+
+class JobStore:
+    """
+    A journal of accepted jobs in an SQLite database (in WAL mode).
+
+    Writes are group committed: everything that queues up while a commit is in
+    progress goes into the next transaction together, so there's one fsync per
+    batch instead of one per job.
+
+    Jobs are added before they're acknowledged to the caller, and removed once
+    they've been run (or deliberately discarded). Whatever is left over when
+    the store is opened is available from pending() for replay.
+    """
+    def __init__(self, path):
+        self.path = path
+        # sqlite connections like to stay on one thread
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="jobstore",
+        )
+        self._ops = []
+        self._wakeup = asyncio.Event()
+        #: Set while everything that's been asked for is on disk
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = None
+        self._next_id = 0
+        self._pending = collections.defaultdict(list)
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(self._executor, self._open)
+        # Deadlines are stored as wall-clock time, but jobs use monotonic time
+        offset = time.monotonic() - time.time()
+        for id, bundle, func, body, extras, priority, deadline in rows:
+            if not isinstance(body, bytes):
+                body = json.loads(body)
+            self._pending[bundle].append(Job(
+                func, body, json.loads(extras),
+                priority=priority,
+                deadline=deadline + offset if deadline is not None else None,
+                id=id,
+            ))
+            self._next_id = max(self._next_id, id + 1)
+        if rows:
+            LOG.info("Recovered %d unfinished jobs from %s", len(rows), self.path)
+        self._task = asyncio.create_task(self._flusher(), name="jobstore-flusher")
+        return self
+
+    async def __aexit__(self, *exc):
+        # Get everything that's been asked for onto disk
+        await self._idle.wait()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._db.close)
+        self._executor.shutdown()
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(_SCHEMA)
+        return self._db.execute(
+            "SELECT id, bundle, func, body, extras, priority, deadline FROM jobs ORDER BY id"
+        ).fetchall()
+
+    def _write(self, ops):
+        """
+        Apply a batch of operations in one transaction.
+        """
+        adds = [row for kind, row in ops if kind == 'add']
+        acks = [(row,) for kind, row in ops if kind == 'ack']
+        self._db.execute("BEGIN")
+        try:
+            if adds:
+                self._db.executemany(
+                    "INSERT INTO jobs (id, bundle, func, body, extras, priority, deadline) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    adds,
+                )
+            if acks:
+                self._db.executemany("DELETE FROM jobs WHERE id = ?", acks)
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        else:
+            self._db.execute("COMMIT")
+
+    async def _flusher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            ops, self._ops = self._ops, []
+            try:
+                await loop.run_in_executor(
+                    self._executor, self._write, [(kind, row) for kind, row, _ in ops],
+                )
+            except Exception as exc:
+                LOG.exception("Error writing %d jobs to %s", len(ops), self.path)
+                for _, _, fut in ops:
+                    if fut is not None and not fut.done():
+                        fut.set_exception(exc)
+            else:
+                for _, _, fut in ops:
+                    if fut is not None and not fut.done():
+                        fut.set_result(None)
+            finally:
+                if not self._ops:
+                    self._wakeup.clear()
+                    self._idle.set()
+
+    def _push(self, kind, row, fut=None):
+        self._ops.append((kind, row, fut))
+        self._idle.clear()
+        self._wakeup.set()
+
+    def encode(self, bundle_name, job):
+        """
+        Turn a job into a row for add(), assigning its id.
+
+        Raises TypeError if the job's body or extras can't be stored. Bodies
+        can be anything JSON can encode, or bytes.
+        """
+        if isinstance(job.body, (bytes, bytearray, memoryview)):
+            body = bytes(job.body)
+        else:
+            body = json.dumps(job.body)
+        extras = json.dumps(job.extras)
+        if job.deadline is not None:
+            deadline = job.deadline - time.monotonic() + time.time()
+        else:
+            deadline = None
+        job.id = self._next_id
+        self._next_id += 1
+        return (job.id, bundle_name, job.func, body, extras, job.priority, deadline)
+
+    async def add(self, row):
+        """
+        Record a job encoded by encode(), returning once it's safely on disk.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._push('add', row, fut)
+        await fut
+
+    def ack(self, job):
+        """
+        Forget about a job that's been dealt with.
+
+        This doesn't wait for the disk; if it's lost, the job is just run again.
+        """
+        if job.id is None:
+            return
+        self._push('ack', job.id)
+
+    def pending(self, bundle_name):
+        """
+        Take the unfinished jobs for a bundle that were found at startup.
+        """
+        return self._pending.pop(bundle_name, [])
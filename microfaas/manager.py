@@ -1,50 +1,205 @@
 import asyncio
+import collections
 import contextlib
 import dataclasses
+import functools
 import logging
+import time
 import typing
 
+from .__runner__ import check_manifest
+from .autoscaler import Autoscaler, ScalingPolicy
+from .buildah import Image
+from .bundles import ingest
+from .images import BundleCache, RunnerImage
+from .jobqueue import Job, JobQueue, Overflow, ResultStream
+from .jobstore import JobStore
 from .runtime import Runtime
+from .scheduler import FairScheduler
+from .warmpool import WarmPool
 
 LOG = logging.getLogger(__name__)
 
 
+class BundleBusyError(Exception):
+    """
+    The bundle's queue is full and it isn't accepting more calls right now
+    """
+
+
+class CallExpiredError(Exception):
+    """
+    The call's deadline passed before it could be made
+    """
+
+
+class BatchMismatchError(Exception):
+    """
+    The runner didn't give one result per call of a batch
+    """
+
+
 @dataclasses.dataclass
 class Bundle:
     """
     Holds a bunch of live objects the manager has to keep track of.
     """
-    #: The source bundle, can be filename, path-like, or file-like
-    # bundle: typing.Any
-    #: The current runtime
-    runtime: Runtime
+    #: The hash of the bundle's contents
+    image_key: str
+    #: The image of the bundle that runtimes are started from
+    image: Image
+    #: The runtimes currently serving this bundle
+    runtimes: typing.List[Runtime]
     #: The call queue
-    queue: asyncio.Queue
+    queue: JobQueue
     #: The task processing the queue
     task: asyncio.Task
+    #: Notified whenever a call finishes or the set of runtimes changes
+    ready: asyncio.Condition = dataclasses.field(default_factory=asyncio.Condition)
+    #: The tasks of calls currently being executed
+    calls: typing.Set[asyncio.Task] = dataclasses.field(default_factory=set)
+    #: Calls taken off the queue that are still waiting for a runtime
+    waiting: int = 0
+    #: How many calls each runtime handles at once
+    concurrency: int = 1
+    #: Modules for a zygote runner to import up front, or None for no zygote
+    preload: typing.Optional[typing.List[str]] = None
+    #: The bundle's manifest, if it has one
+    manifest: typing.Optional[dict] = None
+    #: Options for functions, over those in the manifest
+    functions: typing.Optional[typing.Dict[str, dict]] = None
+    #: How runtimes talk to their runners: 'stdio' or 'socket'
+    transport: str = 'stdio'
+    #: How many connections each runtime has to its runner, or None for the default
+    lanes: typing.Optional[int] = None
+    #: The most calls to one function to send to a runtime together
+    batch_size: int = 1
+    #: Seconds to wait for a batch to fill up
+    batch_wait: float = 0.0
+    #: This bundle's share of the node's capacity, relative to other bundles
+    weight: float = 1.0
+    #: What to do with calls when the queue is full
+    overflow: Overflow = Overflow.BLOCK
+    #: How to size the pool of runtimes, or None for a fixed size
+    scaling: typing.Optional[ScalingPolicy] = None
+    #: Durations (in seconds) of recently completed calls
+    latencies: typing.Deque[float] = dataclasses.field(
+        default_factory=lambda: collections.deque(maxlen=100),
+    )
+
+    def function_options(self, func):
+        """
+        The options for a function, from the manifest and deploy().
+        """
+        options = {}
+        if self.manifest is not None:
+            functions = self.manifest.get('functions')
+            if isinstance(functions, dict):
+                options.update(functions.get(func) or {})
+        if self.functions is not None:
+            options.update(self.functions.get(func) or {})
+        return options
+
+    def timeout(self, jobs):
+        """
+        How long a dispatch of the given jobs (all to one function) may run.
+
+        A batch gets the longest timeout of its jobs, or none if any has none.
+        """
+        default = self.function_options(jobs[0].func).get('timeout')
+        timeouts = [job.timeout if job.timeout is not None else default for job in jobs]
+        if None in timeouts:
+            return None
+        return max(timeouts)
+
+    @property
+    def degraded(self):
+        """
+        Whether every runtime of the bundle is crash looping.
+        """
+        return bool(self.runtimes) and all(rt.degraded for rt in self.runtimes)
 
 
 class Manager:
     #: Holds all the metadata about our deployed bundles
     bundles: typing.Dict[str, Bundle]
 
-    def __init__(self):
+    def __init__(
+        self, *,
+        autoscale_interval=1.0, journal=None, call_budget=None,
+        runner_wheelhouse=None, max_bundle_images=32, max_bundle_bytes=None,
+        warm_containers=2, backend=None, stream_stall_timeout=60.0,
+    ):
+        """
+        If journal (a path) is given, accepted calls are kept there until
+        they've been made, and calls left over from a previous run are queued
+        again when their bundle is deployed.
+
+        call_budget is how many calls may be in progress across all bundles,
+        defaulting to the number of CPUs. It's shared between bundles by
+        weighted fair queuing.
+
+        The image runtimes start from is built once; runner_wheelhouse is a
+        directory of wheels to build it (and bundle requirements) from without
+        network access. Images of up to max_bundle_images bundles (taking up
+        to max_bundle_bytes of disk, if given) are kept around for reuse.
+
+        warm_containers spare runner containers are kept ready to build new
+        bundles in. Bundles with a ScalingPolicy also get a spare container
+        each, ready for the next scale up.
+
+        backend (see backends) is how runtimes get their containers and run
+        the runner in them; by default, with buildah.
+
+        A streaming call whose consumer takes no items for stream_stall_timeout
+        seconds is stopped with StreamStalledError, so that it doesn't hold on
+        to its share of the node forever. None lets streams wait indefinitely.
+        """
         self.bundles = {}
+        self.scheduler = FairScheduler(call_budget)
+        self.runner_image = RunnerImage(wheelhouse=runner_wheelhouse)
+        self.warm_containers = warm_containers
+        self.backend = backend
+        self.stream_stall_timeout = stream_stall_timeout
+        self.pool = WarmPool()
+        self.bundle_images = BundleCache(
+            self.runner_image, max_images=max_bundle_images,
+            max_bytes=max_bundle_bytes, pool=self.pool,
+        )
+        self._warmup = None
+        self.autoscaler = Autoscaler(self, interval=autoscale_interval)
+        self.store = JobStore(journal) if journal is not None else None
 
     async def __aenter__(self):
+        if self.store is not None:
+            await self.store.__aenter__()
+        await self.pool.__aenter__()
+        await self.bundle_images.load()
+        if self.warm_containers:
+            self._warmup = asyncio.create_task(self._warm_up(), name="warm-up")
+        await self.autoscaler.__aenter__()
         return self
 
     async def __aexit__(self, *exc):
         """
         This immediately exits, stopping tasks and freeing containers.
         """
-        # Stop all queue processing tasks
+        await self.autoscaler.__aexit__(*exc)
+        if self._warmup is not None:
+            self._warmup.cancel()
+            try:
+                await self._warmup
+            except asyncio.CancelledError:
+                pass
+
+        # Stop all queue processing tasks and in-progress calls
         tasks = []
         for bdata in self.bundles.values():
-            if bdata.task is None:
-                continue
-            tasks.append(bdata.task)
-            bdata.task.cancel()
+            for task in [bdata.task, *bdata.calls]:
+                if task is None:
+                    continue
+                tasks.append(task)
+                task.cancel()
         # Wait for the tasks to actually exit
         for task in asyncio.as_completed(tasks):
             try:
@@ -55,10 +210,32 @@ class Manager:
                 LOG.exception("Error stopping task %r", task)
         # Clean up the containers
         for name, bdata in self.bundles.items():
-            try:
-                await bdata.runtime.__aexit__(*exc)
-            except Exception:
-                LOG.exception("Error cleaning up runtime for  %s", name)
+            # These stay in the journal, to be picked up next time
+            for job in bdata.queue.drain():
+                job.cancel()
+            await self._stop_runtimes(name, bdata.runtimes, *exc)
+
+        await self.pool.__aexit__(*exc)
+        if self.store is not None:
+            await self.store.__aexit__(*exc)
+
+    async def _warm_up(self):
+        """
+        Get the runner image ready and start keeping spares of it.
+        """
+        try:
+            image = await self.runner_image.get()
+        except Exception:
+            LOG.exception("Error preparing the runner image")
+        else:
+            self.pool.keep_warm(image, self.warm_containers)
+
+    async def _forget_image(self, image):
+        """
+        Stop keeping spares of a bundle image, unless it's still deployed.
+        """
+        if not any(bdata.image is image for bdata in self.bundles.values()):
+            await self.pool.forget(image)
 
     async def join(self):
         """
@@ -68,9 +245,87 @@ class Manager:
         """
         await asyncio.gather(*(bdata.queue.join() for bdata in self.bundles.values()))
 
-    async def deploy(self, name, bundle):
+    async def _start_runtimes(self, image, count, **opts):
+        """
+        Starts count runtimes from the given bundle image concurrently, with
+        the given options.
+
+        If any of them fail, the ones that did start are cleaned up.
+        """
+        runtimes = [
+            Runtime(image, pool=self.pool, backend=self.backend, **opts)
+            for _ in range(count)
+        ]
+        results = await asyncio.gather(
+            *(rt.__aenter__() for rt in runtimes),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            await asyncio.gather(*(
+                rt.__aexit__(None, None, None)
+                for rt, r in zip(runtimes, results)
+                if not isinstance(r, BaseException)
+            ), return_exceptions=True)
+            raise errors[0]
+        return runtimes
+
+    async def _stop_runtimes(self, name, runtimes, *exc):
+        """
+        Cleans up the given runtimes, logging any errors.
+        """
+        if not exc:
+            exc = (None, None, None)
+        for runtime in runtimes:
+            try:
+                await runtime.__aexit__(*exc)
+            except Exception:
+                LOG.exception("Error cleaning up runtime for  %s", name)
+
+    async def deploy(
+        self, name, bundle, *,
+        replicas=1, concurrency=1, scaling=None,
+        queue_limit=0, overflow=Overflow.BLOCK,
+        batch_size=1, batch_wait=0.0, weight=1.0, preload=None,
+        functions=None, transport='stdio', lanes=None,
+    ):
         """
-        Deploy a new bundle at name.
+        Deploy a new bundle at name, backed by replicas runtimes that each
+        handle up to concurrency calls at once.
+
+        bundle is a zip, as a path, bytes, a file-like object, or an async
+        iterable of bytes.
+
+        If scaling (a ScalingPolicy) is given, the number of runtimes will be
+        adjusted to load within its bounds, starting from replicas.
+
+        queue_limit caps how many calls may be waiting (0 for no limit), and
+        overflow (an Overflow) decides what call_func() does once it's reached.
+
+        If batch_size is more than 1, queued calls to the same function are sent
+        to the runner together, up to batch_size at a time, waiting up to
+        batch_wait seconds for more to arrive.
+
+        weight is the bundle's share of the node's call budget when it's
+        contended, relative to other bundles.
+
+        If preload (a list of module names) is given, the runtimes run the
+        runner as a zygote that imports those modules once and forks workers
+        from there, so runner restarts are nearly instant. It defaults to the
+        preload list in the bundle's manifest, if there is one.
+
+        functions maps function names to options that override the manifest's.
+        The option "executor" picks how a synchronous function is run: "inline"
+        on the runner's event loop, in a "thread" pool, or in a "process" pool
+        for CPU-bound work. "workers" sizes a dedicated pool for the function
+        (by default, thread functions share one pool and process pools get a
+        worker per CPU). "timeout" is the most seconds a call may run before
+        it's cancelled.
+
+        transport is how runtimes talk to their runners: over the runner's
+        'stdio', or over a 'socket' in a shared directory, with lanes
+        connections per runtime (one per unit of concurrency by default). The
+        socket transport is always used with preload.
 
         When this function returns, the bundle will be fully deployed and
         operating.
@@ -78,49 +333,147 @@ class Manager:
         If name didn't previously exist, new queues, containers, etc will be
         created.
 
-        If name did exist, only the container will be replaced. Any unprocessed
+        If name did exist, only the containers will be replaced. Any unprocessed
         items in the queue will be handled by the new deployment.
         """
-        old_runtime = None
+        if scaling is not None:
+            replicas = min(max(replicas, scaling.min_replicas), scaling.max_replicas)
+        if replicas < 1:
+            raise ValueError("A bundle needs at least one replica")
+        if weight <= 0:
+            raise ValueError("weight must be positive")
+        overflow = Overflow(overflow)
+        source = await ingest(bundle)
+        try:
+            # Before building anything, since runners would only crash loop
+            check_manifest(source.manifest, functions)
+            key, image = await self.bundle_images.acquire(source)
+        finally:
+            # Once it's in an image, the zip isn't needed any more
+            source.cleanup()
+        manifest = source.manifest
+        if preload is None and manifest is not None:
+            preload = manifest.get('preload')
+        try:
+            runtimes = await self._start_runtimes(
+                image, replicas, concurrency=concurrency, preload=preload,
+                functions=functions, transport=transport, lanes=lanes,
+            )
+        except BaseException:
+            self.bundle_images.release(key)
+            raise
+
         if name in self.bundles:
             # Replacement deploy
             bdata = self.bundles[name]
-            bdata.bundle = bundle
-            new_runtime = Runtime(bundle)
-            await new_runtime.__aenter__()
-            # New runtime ready to accept jobs, swap runtimes
-            old_runtime, bdata.runtime = bdata.runtime, new_runtime
-            # This is so that we transparently swap the current runtime without
+            old_key, old_image = bdata.image_key, bdata.image
+            bdata.image_key, bdata.image = key, image
+            bdata.manifest = manifest
+            bdata.functions = functions
+            bdata.transport = transport
+            bdata.lanes = lanes
+            bdata.concurrency = concurrency
+            bdata.preload = preload
+            bdata.scaling = scaling
+            bdata.overflow = overflow
+            bdata.queue.limit = queue_limit
+            bdata.batch_size = batch_size
+            bdata.batch_wait = batch_wait
+            bdata.weight = weight
+            # New runtimes ready to accept jobs, swap runtimes
+            # This is so that we transparently swap the current runtimes without
             # restarting the queue-processing task.
+            async with bdata.ready:
+                old_runtimes, bdata.runtimes = bdata.runtimes, runtimes
+                bdata.ready.notify_all()
+
+                # Let calls already dispatched to the old runtimes finish
+                await bdata.ready.wait_for(
+                    lambda: all(rt.in_flight == 0 for rt in old_runtimes)
+                )
 
             # Clean up old
-            try:
-                await old_runtime.__aexit__(None, None, None)
-            except Exception:
-                LOG.exception("Error cleaning up old runtime of %s", name)
+            await self._stop_runtimes(name, old_runtimes)
+            self.bundle_images.release(old_key)
+            if old_image is not image:
+                await self._forget_image(old_image)
         else:
             # New deploy
             bdata = self.bundles[name] = Bundle(
-                # bundle=bundle,
-                queue=asyncio.Queue(),
-                runtime=Runtime(bundle),
+                image_key=key,
+                image=image,
+                manifest=manifest,
+                queue=JobQueue(queue_limit),
+                runtimes=runtimes,
                 task=None,  # Later
+                concurrency=concurrency,
+                preload=preload,
+                functions=functions,
+                transport=transport,
+                lanes=lanes,
+                scaling=scaling,
+                overflow=overflow,
+                batch_size=batch_size,
+                batch_wait=batch_wait,
+                weight=weight,
             )
-            # Prepare container
-            await bdata.runtime.__aenter__()
+            if self.store is not None:
+                bdata.queue.restore(self.store.pending(name))
+
+        if scaling is not None:
+            self.pool.keep_warm(image, 1)
+
+        if bdata.task is None:
             # Start queue consumer
-            bdata.task = asyncio.create_task(self._loop_on_jobs(name), name=f"{bundle}-queue-processor")
+            bdata.task = asyncio.create_task(self._loop_on_jobs(name), name=f"{name}-queue-processor")
+
+    async def add_replica(self, name):
+        """
+        Start one more runtime for the given bundle.
+        """
+        bdata = self.bundles[name]
+        image = bdata.image
+        [runtime] = await self._start_runtimes(
+            image, 1, concurrency=bdata.concurrency, preload=bdata.preload,
+            functions=bdata.functions, transport=bdata.transport, lanes=bdata.lanes,
+        )
+        if self.bundles.get(name) is not bdata or bdata.image is not image:
+            # Deleted or redeployed while we were starting
+            await self._stop_runtimes(name, [runtime])
+            return
+        async with bdata.ready:
+            bdata.runtimes.append(runtime)
+            bdata.ready.notify_all()
+
+    async def retire_replica(self, name):
+        """
+        Stop the least-busy runtime of the given bundle.
+
+        The runtime stops receiving new calls immediately, and is cleaned up
+        once the calls it already has finish.
+        """
+        bdata = self.bundles[name]
+        async with bdata.ready:
+            if not bdata.runtimes:
+                return
+            runtime = min(bdata.runtimes, key=lambda rt: rt.in_flight)
+            bdata.runtimes.remove(runtime)
+            await bdata.ready.wait_for(lambda: runtime.in_flight == 0)
+        await self._stop_runtimes(name, [runtime])
 
     async def _loop_on_jobs(self, bundle_name):
         """
-        Consumes a queue, processing each item in turn.
+        Consumes a queue, dispatching each Job to the least-busy runtime.
 
-        The items must be three-tuples of (func, body, extras).
+        A job is only taken off the queue once a runtime has room for it, so
+        that it's picked by priority and deadline when it can actually be run.
+        Jobs whose deadline has passed by the time they'd be dispatched are
+        discarded.
 
-        * func: str: the function to call
-        * body: JSON-ish: the body of the event
-        * extras: dict[str, JSON-ish]: extra data for the event
+        If the bundle batches, consecutive jobs for the same function are
+        dispatched together. Streaming jobs are always dispatched alone.
         """
+        carry = None
         while True:
             try:
                 bundle = self.bundles[bundle_name]
@@ -130,9 +483,248 @@ class Manager:
 
             # This is to allow some of the objects to get swapped out as needed
             q = bundle.queue
-            func, body, extras = await q.get()
-            await bundle.runtime.do_call(func, body, **extras)
-            q.task_done()
+            if carry is not None:
+                job, carry = carry, None
+            else:
+                async with bundle.ready:
+                    await self._spare_runtimes(bundle)
+                job = await q.get()
+            if self._expire(bundle, job):
+                continue
+            jobs = [job]
+            # Off the queue, but the autoscaler still has to count them
+            bundle.waiting = 1
+            try:
+                if bundle.batch_size > 1 and job.stream is None:
+                    carry = await self._fill_batch(bundle, jobs)
+                    bundle.waiting = len(jobs) + (carry is not None)
+                runtime = await self._reserve(bundle_name, bundle)
+            except asyncio.CancelledError:
+                # Don't leave anybody waiting on jobs we took off the queue
+                for job in [*jobs, carry] if carry is not None else jobs:
+                    job.cancel()
+                    q.task_done()
+                raise
+            finally:
+                bundle.waiting = 0
+            # Getting a turn from the scheduler may have taken a while
+            jobs = [job for job in jobs if not self._expire(bundle, job)]
+            if not jobs:
+                self.scheduler.release()
+                await self._release_runtime(bundle, runtime)
+                continue
+            task = asyncio.create_task(
+                self._run_calls(bundle, runtime, jobs),
+                name=f"{bundle_name}-call",
+            )
+            bundle.calls.add(task)
+            task.add_done_callback(bundle.calls.discard)
+            task.add_done_callback(functools.partial(self._calls_done, bundle, runtime, jobs))
+
+    def _calls_done(self, bundle, runtime, jobs, task):
+        """
+        Gives back everything reserved for a dispatch.
+
+        This is a done callback rather than part of the task, so that it also
+        happens if the task was cancelled before it got to run.
+        """
+        self.scheduler.release()
+        for job in jobs:
+            if task.cancelled():
+                job.cancel()
+            bundle.queue.task_done()
+        runtime.in_flight -= 1
+        # Notifying needs the lock, which a callback can't wait for
+        notify = asyncio.create_task(self._notify_ready(bundle), name="notify-ready")
+        bundle.calls.add(notify)
+        notify.add_done_callback(bundle.calls.discard)
+
+    def _expire(self, bundle, job):
+        """
+        If the job's deadline has passed, fail it and return True.
+        """
+        if job.expired():
+            LOG.warning("Call to %s expired before dispatch", job.func)
+            job.set_exception(CallExpiredError(f"Call to {job.func} expired before dispatch"))
+            self._ack(job)
+            bundle.queue.task_done()
+            return True
+        else:
+            return False
+
+    async def _fill_batch(self, bundle, jobs):
+        """
+        Adds jobs for the same function to the batch, until it's full, the
+        queue runs dry past the batch wait, or a different function comes up.
+
+        The job for a different function, if any, is returned so it can be
+        dispatched next.
+        """
+        q = bundle.queue
+        func = jobs[0].func
+        give_up = time.monotonic() + bundle.batch_wait
+        while len(jobs) < bundle.batch_size:
+            try:
+                job = q.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = give_up - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    job = await asyncio.wait_for(q.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if self._expire(bundle, job):
+                continue
+            if job.func != func or job.stream is not None:
+                return job
+            jobs.append(job)
+        return None
+
+    async def _reserve(self, bundle_name, bundle):
+        """
+        Reserves a slot on one of the bundle's runtimes, and then a turn from
+        the node-wide scheduler.
+        """
+        runtime = await self._pick_runtime(bundle)
+        try:
+            await self.scheduler.acquire(bundle_name, bundle.weight)
+        except asyncio.CancelledError:
+            await self._release_runtime(bundle, runtime)
+            raise
+        return runtime
+
+    async def _release_runtime(self, bundle, runtime):
+        """
+        Gives back a slot reserved by _pick_runtime().
+        """
+        runtime.in_flight -= 1
+        await self._notify_ready(bundle)
+
+    async def _notify_ready(self, bundle):
+        """
+        Wakes up everything waiting for the bundle's runtimes to change.
+        """
+        async with bundle.ready:
+            bundle.ready.notify_all()
+
+    async def _pick_runtime(self, bundle):
+        """
+        Waits for a runtime with spare capacity, and reserves a slot on the
+        least-busy one.
+
+        Healthy runtimes are preferred; degraded ones are only picked if
+        there's nothing else, so that calls fail fast.
+        """
+        async with bundle.ready:
+            candidates = await self._spare_runtimes(bundle)
+            runtime = min(candidates, key=lambda rt: (rt.degraded, rt.in_flight))
+            runtime.in_flight += 1
+            return runtime
+
+    async def _spare_runtimes(self, bundle):
+        """
+        Waits for, and returns, the bundle's runtimes with spare capacity.
+
+        bundle.ready must be held.
+        """
+        while True:
+            candidates = [
+                rt for rt in bundle.runtimes
+                if rt.in_flight < rt.capacity
+            ]
+            if candidates:
+                return candidates
+            if not bundle.runtimes:
+                # Scaled to zero; get one started rather than wait out the
+                # autoscaler's interval
+                self.autoscaler.poke()
+            await bundle.ready.wait()
+
+    async def _run_calls(self, bundle, runtime, jobs):
+        """
+        Performs a call (or batch of calls to one function) on a reserved
+        runtime.
+
+        The reservation is released by _calls_done().
+        """
+        start = time.monotonic()
+        for job in jobs:
+            job.dispatched_at = start
+        timeout = bundle.timeout(jobs)
+        try:
+            if jobs[0].stream is not None:
+                [job] = jobs
+                try:
+                    outcomes = [(True, await self._run_stream(runtime, job, timeout))]
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    outcomes = [(False, exc)]
+            elif len(jobs) == 1:
+                [job] = jobs
+                try:
+                    outcomes = [(True, await runtime.do_call(
+                        job.func, job.body, timeout=timeout, **job.extras,
+                    ))]
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    outcomes = [(False, exc)]
+            else:
+                outcomes = await runtime.do_batch(
+                    jobs[0].func,
+                    [(job.body, job.extras) for job in jobs],
+                    timeout=timeout,
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            outcomes = [(False, exc)] * len(jobs)
+
+        if len(outcomes) != len(jobs):
+            # There's no telling which result goes with which call, but
+            # nobody can be left waiting
+            exc = BatchMismatchError(
+                f"{jobs[0].func} gave {len(outcomes)} results for {len(jobs)} calls"
+            )
+            outcomes = [(False, exc)] * len(jobs)
+        for job, (ok, value) in zip(jobs, outcomes):
+            self._ack(job)
+            if ok:
+                job.set_result(value)
+            else:
+                if job.future is None:
+                    # Nobody else is going to hear about it
+                    LOG.error("Error calling %s", job.func, exc_info=value)
+                job.set_exception(value)
+            LOG.debug(
+                "Call to %s: queued %.3fs, ran %.3fs",
+                job.func, job.queue_time, job.run_time,
+            )
+        if all(ok for ok, _ in outcomes):
+            bundle.latencies.append(time.monotonic() - start)
+
+    async def _run_stream(self, runtime, job, timeout):
+        """
+        Feeds the items of a streaming call to its ResultStream, returning how
+        many were delivered.
+
+        timeout applies to each item.
+        """
+        count = 0
+        items = runtime.do_stream(
+            job.func, job.body, window=job.stream.size, timeout=timeout, **job.extras,
+        )
+        try:
+            async for item in items:
+                if not await job.stream.put(item, self.stream_stall_timeout):
+                    LOG.debug("Stream from %s abandoned after %d items", job.func, count)
+                    break
+                count += 1
+        finally:
+            await items.aclose()
+        return count
 
     async def delete(self, name, *, join=False):
         """
@@ -150,38 +742,152 @@ class Manager:
 
         if join:
             await bdata.queue.join()
+        else:
+            for job in bdata.queue.drain():
+                job.cancel()
+                self._ack(job)
 
-        # Stop the queue processing task
-        bdata.task.cancel()
-        try:
-            await bdata.task
-        except asyncio.CancelledError:
-            pass
-        except Exception:
-            LOG.exception("Error stopping task %r for bundle %s", task, name)
-
-        # Clean up the container
-        try:
-            await bdata.runtime.__aexit__(None, None, None)
-        except Exception:
-            LOG.exception("Error cleaning up runtime for  %s", name)
+        # Stop the queue processing task and any calls still running
+        for task in [bdata.task, *bdata.calls]:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                LOG.exception("Error stopping task %r for bundle %s", task, name)
 
-    async def call_func(self, bundle_name, function, body, **extras):
+        # Clean up the containers
+        await self._stop_runtimes(name, bdata.runtimes)
+        self.bundle_images.release(bdata.image_key)
+        await self._forget_image(bdata.image)
+        self.scheduler.forget(name)
+
+    async def call_func(
+        self, bundle_name, function, body, *, priority=0, deadline=None, timeout=None, **extras,
+    ):
         """
         Calls the given function inside the given bundle with the body and extra
         data.
 
-        This is enqueued, not immediate.
+        Calls with a higher priority are made first, and among equal
+        priorities, the earliest deadline goes first. deadline is in terms of
+        time.monotonic(); if it passes before the call is made, the call is
+        skipped.
+
+        timeout is the most seconds the call may run once it's made, over the
+        function's own timeout (see deploy()). If it runs longer, it's
+        cancelled, and fails with CallTimeoutError.
+
+        This is enqueued, not immediate, and the result is discarded. See
+        invoke() to get the result.
+
+        If the bundle's queue is full, this waits, raises BundleBusyError, or
+        discards the oldest queued call, depending on how the bundle was
+        deployed.
 
         function is in the form of pkgutil.resolve_name(): Either
         pkg.module.function or pkg.module:function.
         """
+        job = Job(function, body, extras, priority=priority, deadline=deadline, timeout=timeout)
+        await self._enqueue(bundle_name, job)
+
+    async def invoke(
+        self, bundle_name, function, body, *, priority=0, deadline=None, timeout=None, **extras,
+    ):
+        """
+        Like call_func(), but returns the queued Job.
+
+        Awaiting the job gives the return value of the function, or raises the
+        error it produced. Once it's done, the job's timestamps show how long
+        it spent queued and running.
+        """
+        job = Job(
+            function, body, extras, priority=priority, deadline=deadline, timeout=timeout,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        await self._enqueue(bundle_name, job)
+        return job
+
+    async def invoke_stream(
+        self, bundle_name, function, body, *,
+        priority=0, deadline=None, timeout=None, buffer=16, **extras,
+    ):
+        """
+        Like invoke(), but for generator functions: returns a ResultStream,
+        which gives the function's items as they're produced.
+
+        At most buffer items are held between the function and the consumer of
+        the stream; beyond that, the function is paused. Closing the stream
+        early stops the function, and so does taking no items for the
+        manager's stream_stall_timeout, which ends the stream with
+        StreamStalledError.
+
+        For streams, timeout is the most seconds to wait for each item.
+
+        Streaming calls aren't journaled, since there'd be nobody to consume
+        them after a restart.
+        """
+        job = Job(
+            function, body, extras, priority=priority, deadline=deadline, timeout=timeout,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        stream = ResultStream(job, buffer)
+        await self._enqueue(bundle_name, job)
+        return stream
+
+    def _ack(self, job):
+        """
+        The job has been dealt with; it doesn't need to survive a restart.
+        """
+        if self.store is not None:
+            self.store.ack(job)
+
+    async def _enqueue(self, bundle_name, job):
+        """
+        Adds a job to a bundle's queue, applying its overflow policy.
+
+        If there's a journal, this returns once the job is recorded there.
+        """
         try:
             bdata = self.bundles[bundle_name]
         except KeyError as exc:
             raise ValueError(f"Unable to find bundle {bundle_name}") from exc
 
-        await bdata.queue.put((function, body, extras))
+        row = None
+        if self.store is not None and job.stream is None:
+            # Before it's queued, so a call that can't be journaled is refused
+            # instead of run
+            row = self.store.encode(bundle_name, job)
+
+        if bdata.overflow is Overflow.BLOCK:
+            await bdata.queue.put(job)
+        elif bdata.overflow is Overflow.REJECT:
+            try:
+                bdata.queue.put_nowait(job)
+            except asyncio.QueueFull as exc:
+                raise BundleBusyError(f"Bundle {bundle_name} is busy") from exc
+        elif bdata.overflow is Overflow.DROP_OLDEST:
+            while bdata.queue.full():
+                dropped = bdata.queue.drop_oldest()
+                LOG.warning("Queue for %s is full, dropped call to %s", bundle_name, dropped.func)
+                dropped.set_exception(BundleBusyError(f"Bundle {bundle_name} is busy, call dropped"))
+                self._ack(dropped)
+            bdata.queue.put_nowait(job)
+
+        if row is not None:
+            # Nothing can have taken the job off the queue yet, so its ack
+            # can't be written before it is
+            try:
+                await self.store.add(row)
+            except Exception:
+                if bdata.queue.remove(job):
+                    raise
+                # Too late to take it back, so it's accepted, just not durably
+                LOG.warning("Call to %s was dispatched without being journaled", job.func)
+        if not bdata.runtimes:
+            # Scaled to zero, get something started
+            self.autoscaler.poke()
 
     def __iter__(self):
         """
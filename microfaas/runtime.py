@@ -2,35 +2,205 @@
 Manages the environment that runs bundles.
 """
 import asyncio
-import importlib.resources
+import collections
+import contextlib
+import itertools
+import json
 import logging
-import zipfile
+import pathlib
+import random
+import shutil
+import subprocess
+import tempfile
+import time
 
-from urp.client import ClientSubprocessProtocol, Disconnected
+from urp.client import ClientSubprocessProtocol, Disconnected, connect_unix, get_error
 
-from .buildah import Container
+from .__runner__ import (
+    BATCH_METHOD, CALL_ID, CANCEL_METHOD, CREDIT_METHOD, PAYLOAD_THRESHOLD, STREAM_METHOD,
+    SideChannel,
+)
+from .backends import BuildahBackend
 
 
 LOG = logging.getLogger(__name__)
 
+#: Where the runtime's directory is mounted in the container
+RUN_DIR = '/run/microfaas'
+
+#: Where to make runtime directories, so payloads in them stay in memory
+SHM_DIR = '/dev/shm'
+
+
+class RuntimeDegradedError(Exception):
+    """
+    The runner keeps crashing, so calls aren't being attempted
+    """
+
+
+class CallTimeoutError(Exception):
+    """
+    The call took longer than its timeout
+    """
+
+
+def _quiet(fut):
+    """
+    Retrieves the outcome of a future nobody is waiting on anymore, so asyncio
+    doesn't complain about it.
+    """
+    if not fut.cancelled():
+        fut.exception()
+
+
+def _fail_sends(client):
+    """
+    Makes what's sent on a client whose connection is lost fail with
+    Disconnected. urp leaves it waiting forever instead.
+    """
+    # There's no public way; shutting down blocks sends rather than failing them
+    client._write_proxy._is_blocked.set()
+
+
+def _backoff(attempt, base, cap):
+    """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
 
 class Runtime:
     """
     Manages the container and presents the interface for connections to call
+
+    The container is started from image, which must already have the runner
+    and the bundle in it (see images.BundleCache). If a WarmPool is given, the
+    container is taken from it. backend (see backends) is how the container
+    is got and the runner is run in it; by default, with buildah.
+
+    Up to concurrency calls are in progress at once. With the default stdio
+    transport, they're multiplexed over the one connection to the runner, on
+    its stdin and stdout. With the socket transport, the runner listens on a
+    unix socket in a directory shared with the host, and the runtime opens
+    lanes connections to it (by default, one per unit of concurrency); each
+    call goes down the lane with the fewest calls on it. The function's stdout
+    is then kept apart from the protocol.
+
+    If the runner exits, it's restarted with exponential backoff. If it exits
+    too often, the runtime is marked degraded and calls fail immediately with
+    RuntimeDegradedError, until the runner manages to stay up for a while.
+
+    If preload (a list of module names) is given, the runner is run as a
+    zygote: it imports those modules once, and forks a worker for each
+    connection on the unix socket. Replacing a worker is then a fork, instead
+    of starting python in the container all over again. Each lane gets its own
+    worker (by default, there's one lane). Each runtime has its own container,
+    and so its own zygote; a new replica still pays for the imports once.
+
+    functions maps function names to options (like which executor to run them
+    in) to use over those in the bundle's manifest.
+
+    The runtime has a directory (on tmpfs, where available) mounted into the
+    container. bytes bodies and results of at least payload_threshold bytes
+    are passed through there, rather than being copied through the connection;
+    the function gets a memoryview of the mapped file, and so does the caller.
+
+    Calls can be given a timeout. When it passes, the call fails with
+    CallTimeoutError, and the runner is asked to cancel it. If the runner
+    doesn't within cancel_grace seconds, it's assumed to be stuck, and is
+    killed and restarted.
     """
-    def __init__(self, source):
-        self.zipsource = zipfile.ZipFile(source)
-        self.call_lock = asyncio.Lock()
+    #: Seconds to wait before the first restart of the runner
+    restart_backoff = 0.1
+    #: The most seconds to wait between restarts of the runner
+    restart_backoff_max = 30.0
+    #: This many runner exits within crash_window seconds means degraded
+    crash_limit = 5
+    #: Seconds the runner has to stay up to be considered healthy again
+    crash_window = 60.0
+    #: How many times to try a call that fails because of the connection
+    call_attempts = 3
+    #: Seconds to wait before the first retry of a call
+    call_backoff = 0.05
+    #: The most seconds to wait between retries of a call
+    call_backoff_max = 2.0
+
+    #: Seconds to wait for the runner to start listening on its socket
+    listen_timeout = 60.0
+
+    #: bytes payloads at least this big are passed through the side channel
+    payload_threshold = PAYLOAD_THRESHOLD
+
+    #: Seconds the runner has to stop a cancelled call before it's recycled
+    cancel_grace = 5.0
+
+    def __init__(
+        self, image, *, concurrency=1, pool=None, preload=None, functions=None,
+        transport='stdio', lanes=None, backend=None,
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        if transport not in ('stdio', 'socket'):
+            raise ValueError(f"Unknown transport {transport!r}")
+        self.image = image
+        self.pool = pool
+        self.backend = backend if backend is not None else BuildahBackend()
+        self.preload = list(preload) if preload is not None else None
+        self.functions = functions
+        self.transport = 'socket' if self.preload is not None else transport
+        if lanes is None:
+            lanes = concurrency if self.preload is None and self.transport == 'socket' else 1
+        elif lanes < 1:
+            raise ValueError("lanes must be at least 1")
+        elif lanes > 1 and self.transport == 'stdio':
+            raise ValueError("Multiple lanes need the socket transport")
+        #: How many connections to the runner to have
+        self.lanes = lanes
+        #: The runner's process, when it's listening on a socket
+        self.server = None
+        self._server_lock = asyncio.Lock()
+        self.rundir = None
+        self.side_channel = SideChannel(None)
+        #: How many calls this runtime can have in progress at once
+        self.capacity = concurrency
+        self.call_slots = asyncio.Semaphore(concurrency)
+        #: Calls dispatched to this runtime that haven't finished yet.
+        #: Maintained by the Manager, which uses it for load balancing.
+        self.in_flight = 0
+        #: Whether the runner is crash looping
+        self.degraded = False
+        self.connected = asyncio.Event()
+        #: The connections to the runner
+        self.clients = []
+        self._lane_calls = collections.Counter()
+        self._stream_ids = itertools.count()
+        self._call_ids = itertools.count()
+        self._cancels = set()
 
     async def __aenter__(self):
         self.container = await self._setup_container()
-        self.client = None
-        start_event = asyncio.Event()
-        self.task = asyncio.create_task(self._starter_task(start_event), name=f"starter-{self.zipsource!r}")
-        await start_event.wait()
+        self.rundir = pathlib.Path(tempfile.mkdtemp(
+            prefix='microfaas-run-',
+            dir=SHM_DIR if pathlib.Path(SHM_DIR).is_dir() else None,
+        ))
+        (self.rundir / 'payloads').mkdir()
+        self.side_channel = SideChannel(str(self.rundir / 'payloads'), self.payload_threshold)
+        self.task = asyncio.create_task(self._starter_task(), name=f"starter-{self.image}")
+        # Wait for the runner to start (or the starter to fail)
+        connected = asyncio.ensure_future(self.connected.wait())
+        await asyncio.wait([connected, self.task], return_when=asyncio.FIRST_COMPLETED)
+        if not connected.done():
+            connected.cancel()
+            try:
+                self.task.result()
+            except BaseException:
+                await self._cleanup(None, None, None)
+                raise
         return self
 
     async def __aexit__(self, *exc):
+        for task in list(self._cancels):
+            task.cancel()
         self.task.cancel()
         try:
             await self.task  # Wait for the task to acetually finish
@@ -38,60 +208,421 @@ class Runtime:
             pass
         except Exception:
             LOG.exception("Error cleaning up runtime")
+        await self._cleanup(*exc)
+
+    async def _cleanup(self, *exc):
+        await self._stop_server()
         await self.container.__aexit__(*exc)
+        shutil.rmtree(self.rundir, ignore_errors=True)
 
     async def _setup_container(self):
-        loop = asyncio.get_running_loop()
-
-        cont = await Container('python:3')
         # TODO: Data volume
-        await cont.__aenter__()
-        try:
-            async with cont.mount() as root:
-                await loop.run_in_executor(None, (root / 'app').mkdir)
-                await loop.run_in_executor(None, self.zipsource.extractall, root)
+        return await self.backend.create(self.image, self.pool)
+
+    async def _starter_task(self):
+        exits = collections.deque()
+        restarts = 0
+        started = False
+        while True:
+            try:
+                clients, returncode = await self._spawn()
+            except Exception:
+                if not started:
+                    # Let __aenter__() report it
+                    raise
+                LOG.exception("Error starting runner in %s", self.container)
+            else:
+                started = True
+                try:
+                    if await self._run_clients(clients):
+                        # It stayed up a while, so it's healthy
+                        restarts = 0
+                        exits.clear()
+                except:
+                    await self._close_clients(clients)
+                    raise
+                LOG.info("Inner process exited rc=%s", returncode())
+
+            now = time.monotonic()
+            exits.append(now)
+            while exits[0] < now - self.crash_window:
+                exits.popleft()
+            if len(exits) >= self.crash_limit and not self.degraded:
+                LOG.error(
+                    "Runner in %s exited %d times in %ss, marking degraded",
+                    self.container, len(exits), self.crash_window,
+                )
+                self.degraded = True
 
-            cont.workdir = '/app'
+            await asyncio.sleep(_backoff(restarts, self.restart_backoff, self.restart_backoff_max))
+            restarts += 1
 
-            await cont.run(['pip', 'install', 'unnamed-rpc'], stdout=None)
+    def _runner_command(self, *args):
+        cmd = [
+            'python', '/__runner__.py',
+            '--payloads', f'{RUN_DIR}/payloads',
+            '--payload-threshold', str(self.payload_threshold),
+            *args,
+        ]
+        if self.functions:
+            cmd += ['--functions', json.dumps(self.functions)]
+        return cmd
 
-            with importlib.resources.path('microfaas', '__runner__.py') as src:
-                await cont.copy_in(src, '/__runner__.py')
-        except:
-            await cont.__aexit__(None, None, None)
+    async def _spawn(self):
+        """
+        Starts a runner (if needed) and connects to it.
+
+        Returns the clients, and a function giving the runner's exit status.
+        """
+        if self.transport == 'stdio':
+            transpo, client = await self.container.popen_with_protocol(
+                ClientSubprocessProtocol,
+                self._runner_command(),
+                volumes=[(str(self.rundir), RUN_DIR)],
+            )
+            return [client], transpo.get_returncode
+
+        async with self._server_lock:
+            # If it's being stopped, this waits until it's gone
+            if self.server is None or self.server.returncode is not None:
+                await self._start_server()
+        clients = []
+        try:
+            for _ in range(self.lanes):
+                clients.append(await self._connect())
+        except BaseException:
+            await self._close_clients(clients)
             raise
+        if self.preload is not None:
+            # The zygote reaps workers, so their status isn't available
+            return clients, lambda: None
         else:
-            return cont
+            return clients, lambda: self.server.returncode
+
+    async def _start_server(self):
+        """
+        Starts a runner listening on a socket: a zygote, if there's anything
+        to preload, or a plain server otherwise.
+        """
+        sock = f'{RUN_DIR}/runner.sock'
+        if self.preload is not None:
+            LOG.info("Starting zygote in %s, preloading %s", self.container, self.preload)
+            cmd = self._runner_command('--zygote', sock, *self.preload)
+        else:
+            LOG.info("Starting runner in %s with %d lanes", self.container, self.lanes)
+            cmd = self._runner_command('--listen', sock)
+        self.server = await self.container.popen(
+            cmd,
+            volumes=[(str(self.rundir), RUN_DIR)],
+            stdin=subprocess.PIPE,
+        )
+
+    async def _connect(self):
+        """
+        Opens a connection to the runner's socket. For a zygote, this forks a
+        new worker.
 
-    async def _starter_task(self, start_event):
+        Waits for the runner to start listening, if it hasn't yet.
+        """
+        sock = self.rundir / 'runner.sock'
+        give_up = time.monotonic() + self.listen_timeout
         while True:
             try:
-                transpo, self.client = await self.container.popen_with_protocol(
-                    ClientSubprocessProtocol,
-                    ['python', '/__runner__.py'],
-                )
-                start_event.set()
-                await self.client.finished()
-            except:
-                await self.client.close()  # Tell the process to exit
-                await self.client.finished()  # Actually wait for the process to exit
-                raise
+                return await connect_unix(str(sock))
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self.server.returncode is not None:
+                    raise RuntimeError(f"Runner exited rc={self.server.returncode}")
+                if time.monotonic() > give_up:
+                    raise
+                await asyncio.sleep(0.01)
+
+    async def _stop_server(self):
+        """
+        Stops the runner listening on a socket (and any workers), if it's
+        running.
+        """
+        async with self._server_lock:
+            if self.server is None or self.server.returncode is not None:
+                return
+            # Closing stdin asks it to exit
+            self.server.stdin.close()
+            try:
+                await asyncio.wait_for(self.server.wait(), 5)
+            except asyncio.TimeoutError:
+                self.server.kill()
+                await self.server.wait()
+
+    async def _close_clients(self, clients):
+        for client in clients:
+            await client.close()  # For stdio, this tells the process to exit
+            await client.finished()  # Actually wait for it
+
+    async def _run_clients(self, clients):
+        """
+        Makes the clients available for calls until one of them disconnects.
+        The rest are then closed, so that all the lanes restart together.
+
+        Returns True if they stayed up for at least crash_window.
+        """
+        self.clients = clients
+        self._lane_calls = collections.Counter(dict.fromkeys(clients, 0))
+        self.connected.set()
+        lost = []
+        for client in clients:
+            fut = asyncio.ensure_future(client.finished())
+            fut.add_done_callback(lambda _, client=client: _fail_sends(client))
+            lost.append(fut)
+        finished = asyncio.ensure_future(asyncio.wait(lost, return_when=asyncio.FIRST_COMPLETED))
+        try:
+            await asyncio.wait_for(asyncio.shield(finished), self.crash_window)
+        except asyncio.TimeoutError:
+            if self.degraded:
+                LOG.info("Runner in %s has recovered", self.container)
+            self.degraded = False
+            await finished
+            return True
+        else:
+            return False
+        finally:
+            self.connected.clear()
+            if finished.done():
+                await self._close_clients(clients)
             else:
-                LOG.info("Inner process exited rc=%s", transpo.get_returncode())
-                # TODO: Backoff policy
+                finished.cancel()
+
+    @contextlib.contextmanager
+    def _lane(self):
+        """
+        Picks the connection with the fewest calls on it, and counts the call
+        against it.
+        """
+        client = min(self.clients, key=lambda c: self._lane_calls[c])
+        self._lane_calls[client] += 1
+        try:
+            yield client
+        finally:
+            # Unless the lanes have been replaced in the meantime
+            if client in self._lane_calls:
+                self._lane_calls[client] -= 1
+
+    async def do_call(self, func, body, *, timeout=None, **extra_data):
+        """
+        Calls the function, returning what it returned.
+
+        If the function raised an error, it's raised here (as a
+        urp.client.ApplicationError). If it takes more than timeout seconds,
+        CallTimeoutError is raised.
+        """
+        body = self.side_channel.store(body)
+        try:
+            return self.side_channel.take(await self._call(func, timeout, _=body, **extra_data))
+        finally:
+            self.side_channel.discard(body)
+
+    async def do_batch(self, func, items, *, timeout=None):
+        """
+        Calls the function once for each (body, extra_data) pair in items, in a
+        single round trip to the runner.
+
+        Returns a list of (ok, value) pairs, where value is either the result or
+        the error (a urp.client.ApplicationError).
 
-    async def do_call(self, func, body, **extra_data):
-        async with self.call_lock:
-            while True:
+        timeout applies to the batch as a whole.
+        """
+        items = [
+            {'_': self.side_channel.store(body), **extra_data}
+            for body, extra_data in items
+        ]
+        try:
+            responses = await self._call(BATCH_METHOD, timeout, func=func, items=items)
+        finally:
+            for item in items:
+                self.side_channel.discard(item['_'])
+        return [
+            (True, self.side_channel.take(resp[1])) if resp[0] else (False, get_error(resp[1], resp[2]))
+            for resp in responses
+        ]
+
+    async def do_stream(self, func, body, *, window=16, timeout=None, **extra_data):
+        """
+        Calls a generator function, yielding its items as they arrive.
+
+        The runner sends at most window items ahead of what's been consumed
+        from here, so a slow consumer pauses the function rather than having
+        its output pile up. Errors from the function are raised here.
+
+        timeout is the most seconds to wait for each item.
+
+        Streams aren't retried, since some items may already be consumed.
+        """
+        async with self.call_slots:
+            if self.degraded:
+                raise RuntimeDegradedError(f"Runner in {self.container} is crash looping")
+            await self._wait_connected()
+            with self._lane() as client:
+                stream_id = next(self._stream_ids)
+                call_id = next(self._call_ids)
+                # Top up the credit when half of it is used, so the runner can
+                # keep working while the credit is on its way
+                threshold = max(window // 2, 1)
+                consumed = 0
+                finished = False
+                body = self.side_channel.store(body)
+                call = client[STREAM_METHOD](
+                    func=func, stream=stream_id, window=window, _=body,
+                    **extra_data, **{CALL_ID: call_id},
+                )
+                # urp swallows cancellation of a call, so wait on each item
+                # from a separate task instead of cancelling into it
+                pending = None
                 try:
-                    async for resp in self.client[func](_=body, **extra_data):
+                    while True:
+                        pending = asyncio.ensure_future(call.__anext__())
+                        done, _ = await asyncio.wait([pending], timeout=timeout)
+                        if not done:
+                            finished = True
+                            await self._cancel(client, call_id, pending)
+                            raise CallTimeoutError(f"{func} took more than {timeout}s to produce an item")
+                        try:
+                            resp = pending.result()
+                        except StopAsyncIteration:
+                            break
                         if isinstance(resp, Exception):
-                            LOG.error("Received error: %s", resp)
-                except Exception:
-                    LOG.exception("Error calling %s", func)
-                    # Try again after yielding
-                    await asyncio.sleep(0.001)
-                    # TODO: Backoff policy
+                            finished = True
+                            raise resp
+                        yield self.side_channel.take(resp)
+                        consumed += 1
+                        if consumed >= threshold:
+                            await self._credit(client, stream=stream_id, count=consumed)
+                            consumed = 0
+                    finished = True
+                finally:
+                    if pending is not None and not pending.done():
+                        if not finished:
+                            # We were cancelled while waiting for an item
+                            self._abandon(client, call_id, pending)
+                    else:
+                        if not finished:
+                            # Our consumer left early, stop the function
+                            try:
+                                await self._credit(client, stream=stream_id, stop=True)
+                            except Exception:
+                                pass
+                        await call.aclose()
+                    self.side_channel.discard(body)
+
+    async def _credit(self, client, **params):
+        async for resp in client[CREDIT_METHOD](**params):
+            if isinstance(resp, Exception):
+                raise resp
+
+    async def _collect(self, client, method, params):
+        """
+        Makes a call, returning its last result and error.
+        """
+        result = error = None
+        async for resp in client[method](**params):
+            if isinstance(resp, Exception):
+                error = resp
+            else:
+                result = resp
+        return result, error
+
+    def _abandon(self, client, call_id, call):
+        """
+        Cancels a call in the background.
+        """
+        call.add_done_callback(_quiet)
+        task = asyncio.create_task(self._cancel(client, call_id, call))
+        self._cancels.add(task)
+        task.add_done_callback(self._cancels.discard)
+
+    async def _cancel(self, client, call_id, call):
+        """
+        Asks the runner to cancel a call, and waits for it to finish. If it
+        doesn't within cancel_grace, the runner is recycled.
+
+        call is the future of the call.
+        """
+        cancel = asyncio.ensure_future(self._collect(client, CANCEL_METHOD, {'call': call_id}))
+        cancel.add_done_callback(_quiet)
+        done, _ = await asyncio.wait([call], timeout=self.cancel_grace)
+        if not done and client in self.clients:
+            LOG.error(
+                "Call %s in %s didn't stop within %ss of being cancelled, recycling the runner",
+                call_id, self.container, self.cancel_grace,
+            )
+            await self._recycle()
+            # The call fails now that its connection is gone
+            await asyncio.wait([call], timeout=self.cancel_grace)
+
+    async def _recycle(self):
+        """
+        Kills the runner, so that the starter task starts a fresh one.
+        """
+        await self._stop_server()
+        # For stdio, closing the connection is what kills it
+        await self._close_clients(self.clients)
+
+    async def _wait_connected(self):
+        """
+        Waits for the runner to be up, raising Disconnected if it isn't within
+        call_backoff_max.
+
+        The connections to a runner that's gone (or being recycled) are kept
+        until it's restarted, and a call on them would only fail.
+        """
+        if self.connected.is_set():
+            return
+        try:
+            await asyncio.wait_for(self.connected.wait(), self.call_backoff_max)
+        except asyncio.TimeoutError:
+            raise Disconnected(f"Runner in {self.container} isn't running") from None
+
+    async def _call(self, method, timeout=None, **params):
+        """
+        Makes a call to the runner, retrying (up to call_attempts times) if the
+        connection has problems.
+
+        Raises RuntimeDegradedError without trying if the runner is crash
+        looping, and CallTimeoutError if an attempt takes longer than timeout.
+        """
+        async with self.call_slots:
+            for attempt in range(self.call_attempts):
+                if self.degraded:
+                    raise RuntimeDegradedError(f"Runner in {self.container} is crash looping")
+                if attempt:
+                    await asyncio.sleep(_backoff(attempt - 1, self.call_backoff, self.call_backoff_max))
+                try:
+                    await self._wait_connected()
+                except Disconnected as exc:
+                    last_exc = exc
+                    continue
+                call_id = next(self._call_ids)
+                with self._lane() as client:
+                    # urp swallows cancellation of a call, so run it in a
+                    # separate task instead of cancelling into it
+                    call = asyncio.ensure_future(
+                        self._collect(client, method, {**params, CALL_ID: call_id}),
+                    )
+                    try:
+                        done, _ = await asyncio.wait([call], timeout=timeout)
+                    except asyncio.CancelledError:
+                        self._abandon(client, call_id, call)
+                        raise
+                    if not done:
+                        self._abandon(client, call_id, call)
+                        raise CallTimeoutError(f"Call to {method} took more than {timeout}s")
+                try:
+                    result, error = call.result()
+                except Exception as exc:
+                    LOG.warning("Error calling %s (attempt %d): %s", method, attempt + 1, exc)
+                    last_exc = exc
                     continue
                 else:
                     break
+            else:
+                raise last_exc
+        if error is not None:
+            raise error
+        return result
@@ -0,0 +1,84 @@
+"""
+Shares the node's capacity for calls between bundles.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+
+LOG = logging.getLogger(__name__)
+
+
+class FairScheduler:
+    """
+    A node-wide budget of concurrent calls, handed out between bundles with
+    weighted fair queuing.
+
+    Each grant is tagged with a virtual finish time, which advances by
+    1/weight for the bundle it went to. When calls are waiting, the one with
+    the earliest tag goes next, so a bundle with a burst of calls can't starve
+    the others, and a bundle with twice the weight gets twice the share. A
+    bundle that's been idle starts from the current virtual time, so it can't
+    bank up credit while quiet.
+    """
+    def __init__(self, budget=None):
+        #: How many calls may be in progress across the node
+        self.budget = budget if budget is not None else os.cpu_count() or 1
+        #: How many calls are in progress
+        self.in_use = 0
+        self._vtime = 0.0
+        self._finish = {}
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def _tag(self, name, weight):
+        start = max(self._vtime, self._finish.get(name, 0.0))
+        finish = start + 1.0 / weight
+        self._finish[name] = finish
+        return start, finish
+
+    async def acquire(self, name, weight=1.0):
+        """
+        Wait for a turn to make a call on behalf of the named bundle.
+
+        Every acquire() must be paired with a release().
+        """
+        start, finish = self._tag(name, weight)
+        if self.in_use < self.budget and not self._waiters:
+            self.in_use += 1
+            self._vtime = start
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (finish, next(self._seq), start, fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # We were granted a turn just as we got cancelled
+                self.release()
+            raise
+
+    def release(self):
+        """
+        A call has finished.
+        """
+        self.in_use -= 1
+        self._grant()
+
+    def _grant(self):
+        while self._waiters and self.in_use < self.budget:
+            _, _, start, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                # Gave up waiting
+                continue
+            self.in_use += 1
+            self._vtime = start
+            fut.set_result(None)
+
+    def forget(self, name):
+        """
+        Drop the accounting for a bundle that's gone.
+        """
+        self._finish.pop(name, None)
@@ -0,0 +1,125 @@
+"""
+Containers created ahead of when they're needed.
+"""
+import asyncio
+import collections
+import logging
+
+from .buildah import Container
+
+LOG = logging.getLogger(__name__)
+
+
+class WarmPool:
+    """
+    Keeps spare containers, already created and mounted, for images that are
+    likely to need more soon.
+
+    Taking a container from the pool skips `buildah from` and `buildah mount`,
+    which is most of the cost of a new container. When a spare is taken, the
+    pool creates a replacement in the background.
+    """
+    def __init__(self):
+        self._targets = {}
+        self._spares = collections.defaultdict(list)
+        self._refills = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        for key in list(self._refills):
+            await self._stop_refill(key)
+        for key in list(self._spares):
+            await self._remove_spares(key)
+
+    def keep_warm(self, image, count):
+        """
+        Start keeping count spare containers of the given image.
+        """
+        key = str(image)
+        self._targets[key] = image, count
+        self._refill(key)
+
+    async def forget(self, image):
+        """
+        Stop keeping spares of the given image, and remove any there are.
+        """
+        key = str(image)
+        self._targets.pop(key, None)
+        await self._stop_refill(key)
+        await self._remove_spares(key)
+
+    def keeping(self, image):
+        """
+        Whether spares of the given image are being kept.
+        """
+        return str(image) in self._targets
+
+    def give(self, image, container):
+        """
+        Add a container of the given image to the pool.
+        """
+        self._spares[str(image)].append(container)
+
+    async def take(self, image):
+        """
+        Get a mounted container of the given image, from the pool if possible.
+
+        The container belongs to the caller now, and has to be cleaned up by
+        them.
+        """
+        key = str(image)
+        if self._spares.get(key):
+            cont = self._spares[key].pop()
+        else:
+            cont = await self._create(image)
+        self._refill(key)
+        return cont
+
+    async def _create(self, image):
+        cont = await Container(image)
+        try:
+            await cont.mount_root()
+        except:
+            await cont.__aexit__(None, None, None)
+            raise
+        return cont
+
+    def _refill(self, key):
+        if key not in self._targets:
+            return
+        if key in self._refills and not self._refills[key].done():
+            return
+        self._refills[key] = asyncio.create_task(
+            self._refill_task(key), name=f"warm-{key}",
+        )
+
+    async def _refill_task(self, key):
+        while key in self._targets:
+            image, count = self._targets[key]
+            if len(self._spares[key]) >= count:
+                return
+            try:
+                cont = await self._create(image)
+            except Exception:
+                LOG.exception("Error creating spare container of %s", key)
+                return
+            self._spares[key].append(cont)
+
+    async def _stop_refill(self, key):
+        task = self._refills.pop(key, None)
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _remove_spares(self, key):
+        for cont in self._spares.pop(key, []):
+            try:
+                await cont.__aexit__(None, None, None)
+            except Exception:
+                LOG.exception("Error removing spare container %s", cont)
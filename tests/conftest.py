@@ -0,0 +1,76 @@
+import contextlib
+import io
+import json
+import zipfile
+
+import pytest
+
+import funcs
+from microfaas.backends import FakeBackend
+from microfaas.manager import Manager
+from microfaas.warmpool import WarmPool
+
+
+class FakeBundleCache:
+    """
+    Stands in for BundleCache, without building anything: a bundle's "image"
+    is just named after its digest.
+    """
+    async def load(self):
+        pass
+
+    async def acquire(self, source):
+        return source.digest, f"bundle-{source.digest[:12]}"
+
+    def release(self, key):
+        pass
+
+
+class IdlePool(WarmPool):
+    """
+    A WarmPool that keeps track of what it's asked to keep warm, but never
+    creates containers.
+    """
+    def _refill(self, key):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def reset_funcs():
+    funcs.CALLS.clear()
+    funcs.GATES.clear()
+
+
+@pytest.fixture
+def make_manager():
+    """
+    Gives a function making Managers that run bundles with the fake backend.
+    """
+    @contextlib.asynccontextmanager
+    async def make(**opts):
+        opts.setdefault('autoscale_interval', 0.05)
+        opts.setdefault('backend', FakeBackend())
+        manager = Manager(warm_containers=0, **opts)
+        manager.bundle_images = FakeBundleCache()
+        manager.pool = IdlePool()
+        async with manager:
+            yield manager
+
+    return make
+
+
+@pytest.fixture
+def make_bundle():
+    """
+    Gives a function making the bytes of a bundle zip, with the given
+    manifest.
+    """
+    def make(manifest=None):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            zf.writestr('funcs.py', '')
+            if manifest is not None:
+                zf.writestr('microfaas.json', json.dumps(manifest))
+        return buf.getvalue()
+
+    return make
@@ -0,0 +1,103 @@
+"""
+Functions for the tests to call.
+
+With the fake backend, runners are served in the test process, so these
+share state with the tests.
+"""
+import asyncio
+import os
+import threading
+import time
+
+#: Bodies of the calls made, in order
+CALLS = []
+#: Events that wait() waits on, by name
+GATES = {}
+
+
+def gate(name):
+    """
+    Get the event that calls to wait(name) wait for.
+    """
+    return GATES.setdefault(name, asyncio.Event())
+
+
+async def record(body):
+    CALLS.append(body)
+    return body
+
+
+def double(body):
+    return body * 2
+
+
+def fail(body):
+    raise ValueError(body)
+
+
+async def wait(name):
+    await gate(name).wait()
+    CALLS.append(name)
+    return name
+
+
+def echo(body):
+    return bytes(body)
+
+
+async def sleep(seconds):
+    await asyncio.sleep(seconds)
+    return seconds
+
+
+async def stubborn(seconds):
+    """
+    Sleeps, ignoring being cancelled.
+    """
+    try:
+        await asyncio.sleep(seconds)
+    except asyncio.CancelledError:
+        await asyncio.sleep(seconds)
+    return seconds
+
+
+async def batch_double(bodies):
+    CALLS.append(list(bodies))
+    return [body * 2 for body in bodies]
+
+
+batch_double.microfaas_batch = True
+
+
+async def batch_short(bodies):
+    return [body * 2 for body in bodies[1:]]
+
+
+batch_short.microfaas_batch = True
+
+
+async def count(n):
+    for i in range(n):
+        yield i
+
+
+async def repeat(body):
+    for _ in range(3):
+        yield bytes(body)
+
+
+def typeof(body):
+    return type(body).__name__
+
+
+def getpid(body):
+    return os.getpid()
+
+
+def where(body):
+    return os.getpid(), threading.current_thread().name
+
+
+def block(seconds):
+    time.sleep(seconds)
+    return seconds
@@ -0,0 +1,105 @@
+import asyncio
+import types
+
+import funcs
+from microfaas.autoscaler import Autoscaler, ScalingPolicy
+from microfaas.jobqueue import JobQueue
+from utils import result, run, until
+
+
+class SlowManager:
+    """
+    Just enough of a Manager for the autoscaler, whose runtimes take a while
+    to start.
+    """
+    def __init__(self, names):
+        self.bundles = {
+            name: types.SimpleNamespace(
+                scaling=ScalingPolicy(min_replicas=0, max_replicas=3, scale_up_cooldown=0),
+                runtimes=[], queue=JobQueue(), waiting=1, latencies=[],
+            )
+            for name in names
+        }
+        self.starting = []
+
+    async def add_replica(self, name):
+        self.starting.append(name)
+        await asyncio.sleep(0.2)
+        self.bundles[name].runtimes.append(types.SimpleNamespace(capacity=1, in_flight=1))
+
+    async def retire_replica(self, name):
+        pass
+
+
+def test_scales_bundles_independently():
+    async def main():
+        manager = SlowManager(['a', 'b'])
+        async with Autoscaler(manager, interval=0.01) as autoscaler:
+            autoscaler.poke()
+            await asyncio.sleep(0.1)
+            # Both are starting at once, and neither twice
+            assert sorted(manager.starting) == ['a', 'b']
+            await asyncio.sleep(0.2)
+            assert all(len(b.runtimes) == 1 for b in manager.bundles.values())
+
+    run(main())
+
+
+def test_stops_scaling_on_exit():
+    async def main():
+        manager = SlowManager(['a'])
+        autoscaler = Autoscaler(manager, interval=0.01)
+        await autoscaler.__aenter__()
+        await asyncio.sleep(0.05)
+        assert manager.starting == ['a']
+        await autoscaler.__aexit__(None, None, None)
+        assert autoscaler._scaling == {}
+        assert manager.bundles['a'].runtimes == []
+
+    run(main())
+
+
+def test_scale_from_zero(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy(
+                'b', make_bundle(),
+                scaling=ScalingPolicy(min_replicas=0, max_replicas=2, scale_down_checks=1000),
+            )
+            await manager.retire_replica('b')
+            assert manager.bundles['b'].runtimes == []
+            # A single call is enough to get a runtime started
+            assert await result(manager.invoke('b', 'funcs:double', 1)) == 2
+            assert len(manager.bundles['b'].runtimes) == 1
+
+    run(main())
+
+
+def test_scale_up(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy(
+                'b', make_bundle(),
+                scaling=ScalingPolicy(max_replicas=2, scale_up_checks=1, scale_up_cooldown=0),
+            )
+            jobs = [await manager.invoke('b', 'funcs:wait', 'backlog') for _ in range(4)]
+            await until(lambda: len(manager.bundles['b'].runtimes) == 2)
+            funcs.gate('backlog').set()
+            for job in jobs:
+                await job
+
+    run(main())
+
+
+def test_scale_down(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy(
+                'b', make_bundle(), replicas=2,
+                scaling=ScalingPolicy(
+                    min_replicas=1, max_replicas=2, scale_down_checks=2, scale_down_cooldown=0,
+                ),
+            )
+            await until(lambda: len(manager.bundles['b'].runtimes) == 1)
+
+    run(main())
@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+
+import funcs
+from microfaas.backends import FakeBackend
+from microfaas.runtime import Runtime
+
+
+def test_fake_runtime():
+    async def main():
+        async with Runtime(None, backend=FakeBackend()) as runtime:
+            assert await runtime.do_call('funcs:double', 21) == 42
+            assert await runtime.do_call('funcs:echo', b'\x00\xff') == b'\x00\xff'
+            with pytest.raises(Exception, match='oops'):
+                await runtime.do_call('funcs:fail', 'oops')
+
+    asyncio.run(asyncio.wait_for(main(), 10))
+
+
+def test_fake_manager(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy('b', make_bundle())
+            await manager.call_func('b', 'funcs:record', 'called')
+            await manager.join()
+            assert funcs.CALLS == ['called']
+
+    asyncio.run(asyncio.wait_for(main(), 10))
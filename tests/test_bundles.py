@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import io
+import json
+import zipfile
+
+import pytest
+
+from microfaas.bundles import BundleSource, _member_path, extract_source, ingest
+
+
+def make_zip(path, members):
+    with zipfile.ZipFile(path, 'w') as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return BundleSource(path, hashlib.sha256(path.read_bytes()).hexdigest())
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('a/b.py', 'a/b.py'),
+    ('../evil.py', 'evil.py'),
+    ('/etc/passwd', 'etc/passwd'),
+    ('a/../../b.py', 'a/b.py'),
+    ('..\\..\\evil.py', 'evil.py'),
+    ('./c.py', 'c.py'),
+])
+def test_member_path(tmp_path, name, expected):
+    assert _member_path(tmp_path, name) == tmp_path / expected
+
+
+def test_extract_stays_in_root(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    source = make_zip(tmp_path / 'bundle.zip', {
+        '../outside.py': 'bad',
+        '/abs.py': 'bad',
+        'sub/../../../up.py': 'bad',
+        '..\\win.py': 'bad',
+        'ok/fine.py': 'good',
+    })
+    assert not extract_source(source, root)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['bundle.zip', 'root']
+    written = sorted(str(p.relative_to(root)) for p in root.rglob('*') if p.is_file())
+    assert written == ['abs.py', 'ok/fine.py', 'outside.py', 'sub/up.py', 'win.py']
+
+
+def test_extract_in_parallel(tmp_path):
+    members = {f'pkg/mod{i}.py': f'x = {i}\n' * (i + 1) for i in range(20)}
+    members['pkg/'] = ''
+    members['requirements.txt'] = 'requests\n'
+    source = make_zip(tmp_path / 'bundle.zip', members)
+    root = tmp_path / 'root'
+    root.mkdir()
+    assert extract_source(source, root, workers=3)
+    for name, data in members.items():
+        if not name.endswith('/'):
+            assert (root / name).read_text() == data
+
+
+@pytest.fixture
+def bundle_bytes():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        zf.writestr('funcs.py', '')
+        zf.writestr('microfaas.json', json.dumps({'functions': ['funcs:double']}))
+    return buf.getvalue()
+
+
+async def chunks(data):
+    for i in range(0, len(data), 7):
+        yield data[i:i + 7]
+
+
+@pytest.mark.parametrize('kind', ['bytes', 'file', 'async', 'path'])
+def test_ingest(tmp_path, bundle_bytes, kind):
+    path = tmp_path / 'bundle.zip'
+    path.write_bytes(bundle_bytes)
+    sources = {
+        'bytes': lambda: bundle_bytes,
+        'file': lambda: io.BytesIO(bundle_bytes),
+        'async': lambda: chunks(bundle_bytes),
+        'path': lambda: str(path),
+    }
+    source = asyncio.run(ingest(sources[kind]()))
+    assert source.digest == hashlib.sha256(bundle_bytes).hexdigest()
+    assert source.manifest == {'functions': ['funcs:double']}
+    assert source.path.read_bytes() == bundle_bytes
+    source.cleanup()
+    # Only spool files are removed
+    assert source.path.exists() == (kind == 'path')
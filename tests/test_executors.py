@@ -0,0 +1,57 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from microfaas.backends import FakeBackend
+from microfaas.runtime import CallTimeoutError, Runtime
+from utils import until
+
+
+def run_with_executor(executor, test, **options):
+    async def main():
+        functions = {
+            'funcs:where': {'executor': executor, **options},
+            'funcs:block': {'executor': executor, **options},
+        }
+        async with Runtime(None, backend=FakeBackend(), functions=functions) as runtime:
+            await asyncio.wait_for(test(runtime), 20)
+
+    asyncio.run(main())
+
+
+def test_inline():
+    async def test(runtime):
+        pid, thread = await runtime.do_call('funcs:where', None)
+        assert (pid, thread) == (os.getpid(), threading.current_thread().name)
+
+    run_with_executor('inline', test)
+
+
+def test_thread():
+    async def test(runtime):
+        pid, thread = await runtime.do_call('funcs:where', None)
+        assert pid == os.getpid()
+        assert thread != threading.current_thread().name
+
+    run_with_executor('thread', test, workers=2)
+
+
+def test_process():
+    async def test(runtime):
+        pid, _ = await runtime.do_call('funcs:where', None)
+        assert pid != os.getpid()
+
+    run_with_executor('process', test, workers=1)
+
+
+def test_stuck_process_is_terminated():
+    async def test(runtime):
+        with pytest.raises(CallTimeoutError):
+            await runtime.do_call('funcs:block', 30, timeout=0.2)
+        # Once the cancellation is through, the pool has been replaced
+        await until(lambda: not runtime._cancels)
+        assert await runtime.do_call('funcs:block', 0) == 0
+
+    run_with_executor('process', test, workers=1)
@@ -0,0 +1,161 @@
+import asyncio
+import json
+from subprocess import CalledProcessError
+
+import pytest
+
+from microfaas import buildah, images
+from microfaas.buildah import Image, ImageIndex, _parse_size
+from microfaas.images import BundleCache, RunnerImage
+
+RUNNER = 'a' * 64
+PYTHON = 'b' * 64
+
+
+class FakeBuildah:
+    """
+    Stands in for running buildah, with just enough of images and rmi.
+    """
+    def __init__(self, infos):
+        self.infos = infos
+        self.calls = []
+        #: IDs that can't be removed
+        self.stuck = set()
+
+    async def __call__(self, *cmd, **opts):
+        self.calls.append(cmd)
+        if cmd[0] == 'images':
+            return json.dumps(self.infos)
+        elif cmd[0] == 'rmi':
+            if cmd[1] in self.stuck:
+                raise CalledProcessError(1, ['buildah', *cmd])
+            self.infos = [info for info in self.infos if info['id'] != cmd[1]]
+        return ''
+
+    def removed(self):
+        return [cmd[1] for cmd in self.calls if cmd[0] == 'rmi']
+
+
+@pytest.fixture
+def fake_buildah(monkeypatch):
+    """
+    Gives a function setting up the local images, and a fresh INDEX of them.
+    """
+    def make(*infos):
+        fake = FakeBuildah(list(infos))
+        monkeypatch.setattr(buildah, '_buildah_out', fake)
+        index = ImageIndex()
+        monkeypatch.setattr(buildah, 'INDEX', index)
+        monkeypatch.setattr(images, 'INDEX', index)
+        return fake
+
+    return make
+
+
+@pytest.mark.parametrize('size, expected', [
+    ('1.234 GB', 1234000000),
+    ('12.5 MB', 12500000),
+    ('3 kB', 3000),
+    ('512 B', 512),
+    (' 2 KB ', 2000),
+    (2048, 2048),
+    ('7 furlongs', 7),
+])
+def test_parse_size(size, expected):
+    assert _parse_size(size) == expected
+
+
+def test_lookup(fake_buildah):
+    fake_buildah(
+        {'id': RUNNER, 'names': ['localhost/microfaas-runner:abc'], 'size': '1 GB'},
+        {'id': PYTHON, 'names': ['docker.io/library/python:3'], 'size': '900 MB'},
+    )
+
+    async def main():
+        index = buildah.INDEX
+        assert await index.find('python:3') == PYTHON
+        assert index.lookup('docker.io/library/python:3') == PYTHON
+        assert index.lookup('microfaas-runner:abc') == RUNNER
+        assert index.lookup(RUNNER) == RUNNER
+        assert index.lookup(PYTHON[:12]) == PYTHON
+        # Too short to be taken for an ID
+        assert index.lookup(PYTHON[:11]) is None
+        # The default tag is latest
+        assert index.lookup('python') is None
+        assert index.size(RUNNER) == 1000000000
+
+        # Short names are tagged under localhost, which is looked at first
+        index.tag(RUNNER, 'python:3')
+        assert index.lookup('python:3') == RUNNER
+        assert index.lookup('docker.io/library/python:3') == PYTHON
+        # A name moves to the image it's given to
+        index.tag(RUNNER, 'docker.io/library/python:3')
+        assert list(index.named('docker.io/library/python')) == [(RUNNER, 'docker.io/library/python:3')]
+        index.remove(RUNNER)
+        assert index.lookup('python:3') is None
+        assert index.lookup(RUNNER) is None
+        assert index.size(RUNNER) == 0
+
+    asyncio.run(main())
+
+
+def test_old_runner_images_are_removed(fake_buildah):
+    key = RunnerImage().key()
+    fake = fake_buildah(
+        {'id': RUNNER, 'names': [f'localhost/microfaas-runner:{key}']},
+        {'id': 'c' * 64, 'names': ['localhost/microfaas-runner:old', 'localhost/microfaas-runner:older']},
+        {'id': 'd' * 64, 'names': ['localhost/microfaas-runner:stuck']},
+        {'id': PYTHON, 'names': ['docker.io/library/python:3']},
+    )
+    fake.stuck.add('d' * 64)
+
+    async def main():
+        runner = await RunnerImage().get()
+        assert str(runner) == RUNNER
+        assert sorted(fake.removed()) == ['c' * 64, 'd' * 64]
+        # One that can't be removed is left be
+        assert sorted(id for id, _ in buildah.INDEX.named(images.RUNNER_IMAGE)) == [RUNNER, 'd' * 64]
+
+    asyncio.run(main())
+
+
+class KeepingPool:
+    """
+    Stands in for a WarmPool that keeps spares of some images.
+    """
+    def __init__(self, kept):
+        self.kept = set(kept)
+        self.forgotten = []
+
+    def keeping(self, image):
+        return str(image) in self.kept
+
+    async def forget(self, image):
+        self.forgotten.append(str(image))
+
+
+def test_evict(fake_buildah):
+    fake = fake_buildah()
+    fake.stuck.add('stuck')
+    pool = KeepingPool(['warm'])
+
+    async def main():
+        cache = BundleCache(None, max_images=1, pool=pool)
+        # From least to most recently used
+        for key in ['stuck', 'warm', 'used', 'spare']:
+            cache._images[key] = Image._from_id_only(key)
+        cache._refs['used'] += 1
+
+        await cache._evict()
+        # Failing to remove one doesn't stop the rest being removed
+        assert fake.removed() == ['stuck', 'spare']
+        assert list(cache._images) == ['stuck', 'warm', 'used']
+
+        # It's tried again on the next eviction
+        fake.stuck.clear()
+        await cache._evict()
+        assert fake.removed() == ['stuck', 'spare', 'stuck']
+        assert list(cache._images) == ['warm', 'used']
+        assert pool.forgotten == ['stuck', 'spare', 'stuck']
+
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import pytest
+
+from microfaas.jobqueue import Job, JobQueue
+
+
+def job(body, **opts):
+    return Job('funcs:record', body, {}, **opts)
+
+
+def test_priority_then_deadline():
+    queue = JobQueue()
+    soon = time.monotonic() + 10
+    for j in [
+        job('low'),
+        job('high', priority=5),
+        job('late', priority=1, deadline=soon + 10),
+        job('soon', priority=1, deadline=soon),
+        job('no deadline', priority=1),
+    ]:
+        queue.put_nowait(j)
+    assert [queue.get_nowait().body for _ in range(5)] == [
+        'high', 'soon', 'late', 'no deadline', 'low',
+    ]
+
+
+def test_drop_oldest():
+    queue = JobQueue(3)
+    for j in [job('first'), job('second'), job('urgent', priority=5)]:
+        queue.put_nowait(j)
+    assert queue.full()
+    # The oldest of the lowest priority goes first
+    assert queue.drop_oldest().body == 'first'
+    assert queue.drop_oldest().body == 'second'
+    assert queue.drop_oldest().body == 'urgent'
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.drop_oldest()
+
+
+def test_drop_expired_first():
+    queue = JobQueue(2)
+    queue.put_nowait(job('urgent', priority=5, deadline=time.monotonic() - 1))
+    queue.put_nowait(job('old'))
+    assert queue.drop_oldest().body == 'urgent'
+
+
+def test_limit_change_wakes_putters():
+    async def main():
+        queue = JobQueue(1)
+        queue.put_nowait(job(1))
+        putter = asyncio.create_task(queue.put(job(2)))
+        await asyncio.sleep(0)
+        assert not putter.done()
+        queue.limit = 2
+        await asyncio.wait_for(putter, 1)
+        assert queue.qsize() == 2
+
+    asyncio.run(main())
+
+
+def test_remove():
+    queue = JobQueue()
+    a, b = job('a'), job('b')
+    queue.put_nowait(a)
+    queue.put_nowait(b)
+    assert queue.remove(a)
+    assert not queue.remove(a)
+    assert queue.get_nowait() is b
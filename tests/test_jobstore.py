@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+import pytest
+
+import funcs
+from microfaas.jobqueue import Job
+from microfaas.jobstore import JobStore
+from utils import run, until
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'journal.db')
+
+    async def main():
+        deadline = time.monotonic() + 60
+        async with JobStore(path) as store:
+            jobs = [
+                Job('funcs:record', {'a': 1}, {'x': 1}, priority=3, deadline=deadline),
+                Job('funcs:record', b'raw', {}),
+                Job('funcs:record', memoryview(b'view'), {}),
+                Job('funcs:record', 'done', {}),
+            ]
+            await asyncio.gather(*(store.add(store.encode('b', job)) for job in jobs))
+            store.ack(jobs[-1])
+
+        async with JobStore(path) as store:
+            pending = store.pending('b')
+            assert [job.body for job in pending] == [{'a': 1}, b'raw', b'view']
+            assert pending[0].extras == {'x': 1}
+            assert pending[0].priority == 3
+            assert abs(pending[0].deadline - deadline) < 1
+            assert store.pending('b') == []
+
+    run(main())
+
+
+def test_refuses_what_it_cannot_store(tmp_path):
+    async def main():
+        async with JobStore(str(tmp_path / 'journal.db')) as store:
+            with pytest.raises(TypeError):
+                store.encode('b', Job('funcs:record', {1, 2}, {}))
+
+    run(main())
+
+
+def test_replay(make_manager, make_bundle, tmp_path):
+    journal = str(tmp_path / 'journal.db')
+
+    async def main():
+        async with make_manager(journal=journal) as manager:
+            await manager.deploy('b', make_bundle())
+            await manager.call_func('b', 'funcs:wait', 'stuck')
+            await manager.call_func('b', 'funcs:record', b'queued')
+            await until(lambda: manager.bundles['b'].runtimes[0].in_flight)
+        assert funcs.CALLS == []
+
+        # Both are run by the next manager to use the journal
+        funcs.gate('stuck').set()
+        async with make_manager(journal=journal) as manager:
+            await manager.deploy('b', make_bundle())
+            await manager.join()
+        assert len(funcs.CALLS) == 2
+        assert set(funcs.CALLS) == {b'queued', 'stuck'}
+
+        async with JobStore(journal) as store:
+            assert store.pending('b') == []
+
+    run(main())
+
+
+def test_unjournalable_calls_are_not_run(make_manager, make_bundle, tmp_path):
+    async def main():
+        async with make_manager(journal=str(tmp_path / 'journal.db')) as manager:
+            await manager.deploy('b', make_bundle())
+            with pytest.raises(TypeError):
+                await manager.invoke('b', 'funcs:record', {1, 2})
+            assert manager.bundles['b'].queue.qsize() == 0
+            await manager.join()
+            assert funcs.CALLS == []
+
+    run(main())
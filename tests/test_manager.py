@@ -0,0 +1,202 @@
+import asyncio
+import time
+
+import pytest
+
+import funcs
+from microfaas.jobqueue import StreamStalledError
+from microfaas.manager import BatchMismatchError, BundleBusyError, CallExpiredError
+from microfaas.runtime import CallTimeoutError
+from utils import result, run, until
+
+
+def test_reject_overflow(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy('b', make_bundle(), queue_limit=1, overflow='reject')
+            busy = await manager.invoke('b', 'funcs:wait', 'busy')
+            await until(lambda: busy.dispatched_at is not None)
+            queued = await manager.invoke('b', 'funcs:double', 1)
+            with pytest.raises(BundleBusyError):
+                await manager.invoke('b', 'funcs:double', 2)
+            funcs.gate('busy').set()
+            assert await queued == 2
+
+    run(main())
+
+
+def test_drop_oldest_overflow(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy('b', make_bundle(), queue_limit=1, overflow='drop-oldest')
+            busy = await manager.invoke('b', 'funcs:wait', 'busy')
+            await until(lambda: busy.dispatched_at is not None)
+            dropped = await manager.invoke('b', 'funcs:double', 1)
+            kept = await manager.invoke('b', 'funcs:double', 2)
+            with pytest.raises(BundleBusyError):
+                await dropped
+            funcs.gate('busy').set()
+            assert await kept == 4
+
+    run(main())
+
+
+def test_priority(make_manager, make_bundle):
+    async def main():
+        async with make_manager(call_budget=1) as manager:
+            await manager.deploy('b', make_bundle())
+            busy = await manager.invoke('b', 'funcs:wait', 'busy')
+            await until(lambda: busy.dispatched_at is not None)
+            jobs = [
+                await manager.invoke('b', 'funcs:record', 'low', priority=0),
+                await manager.invoke('b', 'funcs:record', 'high', priority=10),
+                await manager.invoke('b', 'funcs:record', 'middle', priority=5),
+            ]
+            funcs.gate('busy').set()
+            for job in [busy, *jobs]:
+                await job
+            assert funcs.CALLS == ['busy', 'high', 'middle', 'low']
+
+    run(main())
+
+
+def test_expired_before_dispatch(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy('b', make_bundle())
+            busy = await manager.invoke('b', 'funcs:wait', 'busy')
+            await until(lambda: busy.dispatched_at is not None)
+            late = await manager.invoke(
+                'b', 'funcs:record', 'late', deadline=time.monotonic() - 1,
+            )
+            funcs.gate('busy').set()
+            with pytest.raises(CallExpiredError):
+                await late
+            assert funcs.CALLS == ['busy']
+
+    run(main())
+
+
+def test_priority_while_busy(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy('b', make_bundle())
+            busy = await manager.invoke('b', 'funcs:wait', 'busy')
+            await until(lambda: busy.dispatched_at is not None)
+            low = await manager.invoke('b', 'funcs:record', 'low')
+            await asyncio.sleep(0.05)
+            # Arriving later doesn't matter while nothing could be run anyway
+            high = await manager.invoke('b', 'funcs:record', 'high', priority=100)
+            funcs.gate('busy').set()
+            await low
+            await high
+            assert funcs.CALLS == ['busy', 'high', 'low']
+
+    run(main())
+
+
+def test_expired_while_waiting_for_a_turn(make_manager, make_bundle):
+    async def main():
+        async with make_manager(call_budget=1) as manager:
+            await manager.deploy('a', make_bundle())
+            await manager.deploy('b', make_bundle())
+            busy = await manager.invoke('a', 'funcs:wait', 'busy')
+            await until(lambda: busy.dispatched_at is not None)
+            # b has a runtime free, but the node's only turn is taken
+            late = await manager.invoke(
+                'b', 'funcs:record', 'late', deadline=time.monotonic() + 0.1,
+            )
+            await asyncio.sleep(0.2)
+            funcs.gate('busy').set()
+            with pytest.raises(CallExpiredError):
+                await late
+            assert funcs.CALLS == ['busy']
+            await until(lambda: manager.scheduler.in_use == 0)
+            assert manager.bundles['b'].runtimes[0].in_flight == 0
+
+    run(main())
+
+
+def test_invoke(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy('b', make_bundle())
+            job = await manager.invoke('b', 'funcs:double', 21)
+            assert await job == 42
+            assert job.queue_time >= 0
+            assert job.run_time >= 0
+            assert job.total_time >= job.run_time
+            assert await result(manager.invoke('b', 'funcs:echo', b'bytes')) == b'bytes'
+            with pytest.raises(Exception, match='oops'):
+                await result(manager.invoke('b', 'funcs:fail', 'oops'))
+
+    run(main())
+
+
+def test_timeout(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy('b', make_bundle())
+            with pytest.raises(CallTimeoutError):
+                await result(manager.invoke('b', 'funcs:sleep', 5, timeout=0.1))
+            assert await result(manager.invoke('b', 'funcs:double', 1)) == 2
+            await until(lambda: manager.scheduler.in_use == 0)
+
+    run(main())
+
+
+def test_batching(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy('b', make_bundle(), batch_size=4, batch_wait=0.2)
+            jobs = [await manager.invoke('b', 'funcs:batch_double', i) for i in range(4)]
+            assert [await job for job in jobs] == [0, 2, 4, 6]
+            assert funcs.CALLS == [[0, 1, 2, 3]]
+
+    run(main())
+
+
+def test_batch_mismatch_fails_every_call(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy('b', make_bundle(), batch_size=3, batch_wait=0.2)
+            [runtime] = manager.bundles['b'].runtimes
+
+            async def do_batch(func, items, *, timeout=None):
+                # A runner that loses an outcome
+                return [(True, body) for body, _ in items[1:]]
+
+            runtime.do_batch = do_batch
+            jobs = [await manager.invoke('b', 'funcs:double', i) for i in range(3)]
+            for job in jobs:
+                with pytest.raises(BatchMismatchError):
+                    await job
+            # Given back once the dispatch is done
+            await until(lambda: manager.scheduler.in_use == 0 and runtime.in_flight == 0)
+
+    run(main())
+
+
+def test_stream(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy('b', make_bundle())
+            stream = await manager.invoke_stream('b', 'funcs:count', 5, buffer=2)
+            assert [item async for item in stream] == [0, 1, 2, 3, 4]
+            assert await stream.job == 5
+
+    run(main())
+
+
+def test_stalled_stream(make_manager, make_bundle):
+    async def main():
+        async with make_manager(stream_stall_timeout=0.1) as manager:
+            await manager.deploy('b', make_bundle())
+            stream = await manager.invoke_stream('b', 'funcs:count', 100, buffer=2)
+            # Nobody reads the stream, but its slots are given back
+            with pytest.raises(StreamStalledError):
+                await stream.job
+            await until(lambda: manager.scheduler.in_use == 0)
+            assert await result(manager.invoke('b', 'funcs:double', 1)) == 2
+
+    run(main())
@@ -0,0 +1,64 @@
+import asyncio
+import contextlib
+
+import pytest
+from urp.client import ApplicationError
+
+from microfaas.backends import FakeBackend
+from microfaas.runtime import Runtime
+from utils import result, run
+
+MANIFEST = {'functions': {'funcs:double': None, 'funcs:getpid': {'executor': 'inline'}}}
+
+
+@contextlib.contextmanager
+def not_exported():
+    with pytest.raises(ApplicationError) as excinfo:
+        yield
+    assert type(excinfo.value).__name__.endswith('NotAMethod')
+
+
+def test_only_exported_functions_can_be_called():
+    async def main():
+        async with Runtime(None, backend=FakeBackend(MANIFEST)) as runtime:
+            assert await runtime.do_call('funcs:double', 2) == 4
+            with not_exported():
+                await runtime.do_call('funcs:record', 1)
+            outcomes = await runtime.do_batch('funcs:double', [(1, {})])
+            assert outcomes == [(True, 2)]
+            with pytest.raises(ApplicationError, match='funcs:record'):
+                await runtime.do_batch('funcs:record', [(1, {})])
+            with pytest.raises(ApplicationError, match='funcs:record'):
+                async for _ in runtime.do_stream('funcs:record', 1):
+                    pass
+
+    asyncio.run(asyncio.wait_for(main(), 10))
+
+
+def test_deployed_manifest(make_manager, make_bundle):
+    async def main():
+        async with make_manager(backend=FakeBackend(MANIFEST)) as manager:
+            await manager.deploy('b', make_bundle(MANIFEST))
+            assert await result(manager.invoke('b', 'funcs:double', 21)) == 42
+            with not_exported():
+                await result(manager.invoke('b', 'funcs:fail', 'not exported'))
+
+    run(main())
+
+
+def test_deploy_checks_manifest(make_manager, make_bundle):
+    async def main():
+        async with make_manager() as manager:
+            bad = make_bundle({'functions': {'funcs:double': {'executor': 'bogus'}}})
+            with pytest.raises(ValueError, match='bogus'):
+                await manager.deploy('b', bad)
+            with pytest.raises(ValueError, match='workers'):
+                await manager.deploy(
+                    'b', make_bundle({'functions': ['funcs:double']}),
+                    functions={'funcs:double': {'workers': 0}},
+                )
+            with pytest.raises(ValueError, match='preload'):
+                await manager.deploy('b', make_bundle({'preload': 'funcs'}))
+            assert list(manager) == []
+
+    run(main())
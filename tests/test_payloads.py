@@ -0,0 +1,102 @@
+import asyncio
+import os
+
+import msgpack
+import pytest
+
+from microfaas.__runner__ import PAYLOAD_EXT, SideChannel
+from microfaas.backends import FakeBackend
+from microfaas.runtime import Runtime
+from utils import result, run
+
+BIG = bytes(range(256)) * 4
+
+
+def test_side_channel(tmp_path):
+    channel = SideChannel(str(tmp_path), threshold=100)
+    assert channel.store(b'small') == b'small'
+    assert channel.store('not bytes' * 100) == 'not bytes' * 100
+
+    ref = channel.store(BIG)
+    assert isinstance(ref, msgpack.ExtType) and ref.code == PAYLOAD_EXT
+    # What goes over the connection is just the reference
+    assert msgpack.unpackb(msgpack.packb(ref)) == ref
+    assert len(os.listdir(tmp_path)) == 1
+
+    assert channel.load(ref) == BIG
+    assert len(os.listdir(tmp_path)) == 1
+    view = channel.take(ref)
+    assert os.listdir(tmp_path) == []
+    # The mapping outlives the file
+    assert view == BIG
+    assert channel.load(b'small') == b'small'
+    channel.discard(ref)
+
+
+def test_side_channel_refuses_bad_references(tmp_path):
+    channel = SideChannel(str(tmp_path), threshold=100)
+    for name in [b'../../etc/passwd', b'', b'A' * 32, b'0' * 31]:
+        with pytest.raises(ValueError):
+            channel.load(msgpack.ExtType(PAYLOAD_EXT, name))
+    # Without a directory, nothing goes through it
+    inline = SideChannel(None, threshold=100)
+    assert inline.store(BIG) is BIG
+    with pytest.raises(ValueError):
+        inline.load(channel.store(BIG))
+
+
+def run_with_payloads(test):
+    async def main():
+        runtime = Runtime(None, backend=FakeBackend())
+        runtime.payload_threshold = 100
+        async with runtime:
+            await asyncio.wait_for(test(runtime), 10)
+            # Every payload file is removed once it's been read
+            assert os.listdir(runtime.rundir / 'payloads') == []
+
+    asyncio.run(main())
+
+
+def test_call():
+    async def test(runtime):
+        assert await runtime.do_call('funcs:echo', BIG) == BIG
+        assert await runtime.do_call('funcs:typeof', BIG) == 'memoryview'
+        assert await runtime.do_call('funcs:typeof', b'small') == 'bytes'
+        with pytest.raises(Exception):
+            await runtime.do_call('funcs:fail', BIG)
+
+    run_with_payloads(test)
+
+
+def test_batch():
+    async def test(runtime):
+        outcomes = await runtime.do_batch('funcs:echo', [(BIG, {}), (b'small', {})])
+        assert outcomes == [(True, BIG), (True, b'small')]
+
+    run_with_payloads(test)
+
+
+def test_stream():
+    async def test(runtime):
+        items = [item async for item in runtime.do_stream('funcs:repeat', BIG, window=2)]
+        assert items == [BIG] * 3
+
+    run_with_payloads(test)
+
+
+def test_manager(make_manager, make_bundle, monkeypatch):
+    monkeypatch.setattr(Runtime, 'payload_threshold', 100)
+
+    async def main():
+        async with make_manager() as manager:
+            await manager.deploy('b', make_bundle(), batch_size=2, batch_wait=0.1)
+            # Sent together as a batch
+            jobs = [await manager.invoke('b', 'funcs:echo', body) for body in [BIG, b'small']]
+            assert [await job for job in jobs] == [BIG, b'small']
+            assert await result(manager.invoke('b', 'funcs:typeof', BIG)) == 'memoryview'
+            stream = await manager.invoke_stream('b', 'funcs:repeat', BIG, buffer=1)
+            assert [item async for item in stream] == [BIG] * 3
+            [runtime] = manager.bundles['b'].runtimes
+            assert os.listdir(runtime.rundir / 'payloads') == []
+
+    run(main())
@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+import pytest
+
+from microfaas.backends import FakeBackend
+from microfaas.runtime import CallTimeoutError, Runtime
+from utils import until
+
+
+def run_with_runtime(test, **opts):
+    async def main():
+        async with Runtime(None, backend=FakeBackend(), **opts) as runtime:
+            await asyncio.wait_for(test(runtime), 10)
+
+    asyncio.run(main())
+
+
+def test_socket_transport():
+    async def test(runtime):
+        # One connection per unit of concurrency
+        assert len(runtime.clients) == 3
+        results = await asyncio.gather(*(runtime.do_call('funcs:sleep', 0.2) for _ in range(3)))
+        assert results == [0.2] * 3
+        assert await runtime.do_call('funcs:echo', b'\x00\xff') == b'\x00\xff'
+
+    start = time.monotonic()
+    run_with_runtime(test, transport='socket', concurrency=3)
+    assert time.monotonic() - start < 0.6
+
+
+def test_concurrency():
+    async def test(runtime):
+        results = await asyncio.gather(*(runtime.do_call('funcs:sleep', 0.2) for _ in range(4)))
+        assert results == [0.2] * 4
+
+    start = time.monotonic()
+    run_with_runtime(test, concurrency=4)
+    # Four calls at once, not one after the other
+    assert time.monotonic() - start < 0.8
+
+
+def test_batch():
+    async def test(runtime):
+        outcomes = await runtime.do_batch('funcs:double', [(1, {}), (2, {}), (3, {})])
+        assert outcomes == [(True, 2), (True, 4), (True, 6)]
+
+        outcomes = await runtime.do_batch('funcs:fail', [('a', {}), ('b', {})])
+        assert [ok for ok, _ in outcomes] == [False, False]
+
+    run_with_runtime(test)
+
+
+def test_batching_function():
+    async def test(runtime):
+        outcomes = await runtime.do_batch('funcs:batch_double', [(1, {}), (2, {})])
+        assert outcomes == [(True, 2), (True, 4)]
+
+    run_with_runtime(test)
+
+
+def test_batch_short_of_results():
+    async def test(runtime):
+        outcomes = await runtime.do_batch('funcs:batch_short', [(1, {}), (2, {}), (3, {})])
+        # Every item fails, rather than some going missing
+        assert len(outcomes) == 3
+        assert not any(ok for ok, _ in outcomes)
+
+    run_with_runtime(test)
+
+
+def test_stream():
+    async def test(runtime):
+        items = [item async for item in runtime.do_stream('funcs:count', 5, window=2)]
+        assert items == [0, 1, 2, 3, 4]
+
+    run_with_runtime(test)
+
+
+def test_timeout():
+    async def test(runtime):
+        with pytest.raises(CallTimeoutError):
+            await runtime.do_call('funcs:sleep', 5, timeout=0.1)
+        # Still usable afterwards
+        assert await runtime.do_call('funcs:double', 2) == 4
+
+    run_with_runtime(test)
+
+
+def test_stuck_call_recycles_the_runner():
+    async def test(runtime):
+        runtime.cancel_grace = 0.1
+        with pytest.raises(CallTimeoutError):
+            await runtime.do_call('funcs:stubborn', 5, timeout=0.1)
+        await until(lambda: not runtime._cancels)
+        assert await runtime.do_call('funcs:double', 2) == 4
+
+    run_with_runtime(test)
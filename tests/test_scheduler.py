@@ -0,0 +1,89 @@
+import asyncio
+
+import funcs
+from microfaas.scheduler import FairScheduler
+from utils import run, until
+
+
+def test_fair_share():
+    async def main():
+        scheduler = FairScheduler(1)
+        await scheduler.acquire('a')
+        order = []
+
+        async def call(name, weight=1.0):
+            await scheduler.acquire(name, weight)
+            order.append(name)
+
+        # a has a backlog before b shows up, but doesn't get to starve it
+        tasks = [asyncio.create_task(call(name)) for name in 'aaabbb']
+        await asyncio.sleep(0)
+        for _ in tasks:
+            scheduler.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        assert order == ['b', 'a', 'b', 'a', 'b', 'a']
+
+    run(main())
+
+
+def test_weights():
+    async def main():
+        scheduler = FairScheduler(1)
+        await scheduler.acquire('heavy', 2.0)
+        order = []
+
+        async def call(name, weight):
+            await scheduler.acquire(name, weight)
+            order.append(name)
+
+        tasks = [
+            asyncio.create_task(call(name, weight))
+            for name, weight in [('light', 1.0)] * 3 + [('heavy', 2.0)] * 6
+        ]
+        await asyncio.sleep(0)
+        for _ in tasks:
+            scheduler.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        # Twice the weight, twice the turns
+        assert order[:6].count('heavy') == 4
+
+    run(main())
+
+
+def test_cancelled_waiter():
+    async def main():
+        scheduler = FairScheduler(1)
+        await scheduler.acquire('a')
+        waiter = asyncio.create_task(scheduler.acquire('b'))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        scheduler.release()
+        assert scheduler.in_use == 0
+
+    run(main())
+
+
+def test_budget_shared_between_bundles(make_manager, make_bundle):
+    async def main():
+        async with make_manager(call_budget=1) as manager:
+            await manager.deploy('a', make_bundle(), concurrency=4)
+            await manager.deploy('b', make_bundle(), concurrency=4)
+            busy = await manager.invoke('a', 'funcs:wait', 'busy')
+            await until(lambda: busy.dispatched_at is not None)
+            queued = [
+                await manager.invoke('a', 'funcs:record', 'a'),
+                await manager.invoke('b', 'funcs:record', 'b'),
+            ]
+            await asyncio.sleep(0.05)
+            # Both bundles have room, but the node doesn't
+            assert funcs.CALLS == []
+            funcs.gate('busy').set()
+            for job in queued:
+                await job
+            assert sorted(funcs.CALLS) == ['a', 'b', 'busy']
+            await until(lambda: manager.scheduler.in_use == 0)
+
+    run(main())
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import signal
+import sys
+
+import microfaas.__runner__
+from microfaas.backends import Backend
+from microfaas.runtime import Runtime
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+
+class LocalContainer:
+    """
+    Runs the runner as a subprocess of the tests, so that a zygote really
+    forks its workers.
+    """
+    def __str__(self):
+        return "local"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    @staticmethod
+    def _command(cmd, volumes):
+        [(host, guest)] = volumes
+        return [
+            sys.executable, microfaas.__runner__.__file__,
+            *(arg.replace(guest, host) for arg in cmd[2:]),
+        ]
+
+    @staticmethod
+    def _environ():
+        path = [TESTS, *os.environ.get('PYTHONPATH', '').split(os.pathsep)]
+        return {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, path))}
+
+    async def popen(self, cmd, *, volumes=None, stdin=None, stdout=None, stderr=None):
+        return await asyncio.create_subprocess_exec(
+            *self._command(cmd, volumes), stdin=stdin, stdout=stdout, stderr=stderr,
+            cwd=TESTS, env=self._environ(),
+        )
+
+    async def popen_with_protocol(self, protocol, cmd, *, volumes=None, **opts):
+        return await asyncio.get_running_loop().subprocess_exec(
+            protocol, *self._command(cmd, volumes), cwd=TESTS, env=self._environ(), **opts,
+        )
+
+
+class LocalBackend(Backend):
+    async def create(self, image, pool=None):
+        return LocalContainer()
+
+
+def run_with_zygote(test):
+    async def main():
+        async with Runtime(None, backend=LocalBackend(), preload=['funcs']) as runtime:
+            runtime.restart_backoff = 0.01
+            await asyncio.wait_for(test(runtime), 20)
+
+    asyncio.run(main())
+
+
+def test_workers_are_forked():
+    async def test(runtime):
+        worker = await runtime.do_call('funcs:getpid', None)
+        assert worker != runtime.server.pid
+        # The bundle's modules came from the zygote
+        assert await runtime.do_call('funcs:double', 2) == 4
+
+    run_with_zygote(test)
+
+
+def test_dead_worker_is_replaced():
+    async def test(runtime):
+        container, zygote = runtime.container, runtime.server.pid
+        worker = await runtime.do_call('funcs:getpid', None)
+        os.kill(worker, signal.SIGKILL)
+        replacement = await runtime.do_call('funcs:getpid', None)
+        assert replacement != worker
+        # Forked from the same zygote, in the same container
+        assert runtime.server.pid == zygote
+        assert runtime.container is container
+
+    run_with_zygote(test)
+
+
+def test_dead_zygote_is_restarted():
+    async def test(runtime):
+        container, zygote = runtime.container, runtime.server.pid
+        worker = await runtime.do_call('funcs:getpid', None)
+        os.kill(zygote, signal.SIGKILL)
+        os.kill(worker, signal.SIGKILL)
+        assert await runtime.do_call('funcs:double', 3) == 6
+        assert runtime.server.pid != zygote
+        assert runtime.container is container
+
+    run_with_zygote(test)
@@ -0,0 +1,26 @@
+"""
+Helpers for tests driving a Manager.
+"""
+import asyncio
+
+
+def run(coro):
+    """
+    Runs a test's coroutine, failing it if it hangs.
+    """
+    asyncio.run(asyncio.wait_for(coro, 10))
+
+
+async def until(predicate):
+    """
+    Waits for something the manager does in the background.
+    """
+    while not predicate():
+        await asyncio.sleep(0.01)
+
+
+async def result(invoking):
+    """
+    Awaits the job from Manager.invoke(), and then its result.
+    """
+    return await (await invoking)